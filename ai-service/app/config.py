@@ -2,6 +2,11 @@
 import os
 from typing import Optional
 
+from dotenv import load_dotenv
+
+# 在读取配置前加载 .env，配置类属性在导入时即求值
+load_dotenv()
+
 class AIServiceConfig:
     """AI服务配置类"""
     
@@ -11,6 +16,15 @@ class AIServiceConfig:
     OPENAI_MAX_TOKENS: int = int(os.getenv('OPENAI_MAX_TOKENS', '500'))
     OPENAI_TEMPERATURE: float = float(os.getenv('OPENAI_TEMPERATURE', '0.3'))
     
+    # 模型路由与 token 预算
+    OPENAI_FAST_MODEL: str = os.getenv('OPENAI_FAST_MODEL', '')  # 小邮件使用的更便宜模型（如 gpt-4o-mini），默认留空不路由
+    FAST_MODEL_TOKEN_THRESHOLD: int = int(os.getenv('FAST_MODEL_TOKEN_THRESHOLD', '400'))
+    MAX_INPUT_TOKENS: int = int(os.getenv('MAX_INPUT_TOKENS', '3000'))  # 单次请求正文 token 上限
+    OVERSIZE_POLICY: str = os.getenv('OVERSIZE_POLICY', 'trim')  # trim: 裁剪超长正文, reject: 直接拒绝
+    CHAT_MAX_TOKENS: int = int(os.getenv('CHAT_MAX_TOKENS', '300'))
+    REPLY_MAX_TOKENS: int = int(os.getenv('REPLY_MAX_TOKENS', '400'))
+    TOKENIZER_LOAD_TIMEOUT: float = float(os.getenv('TOKENIZER_LOAD_TIMEOUT', '10'))  # 启动时等待 tiktoken 编码加载的秒数
+    
     # 服务配置
     AI_SERVICE_PORT: int = int(os.getenv('AI_SERVICE_PORT', '8001'))
     AI_SERVICE_HOST: str = os.getenv('AI_SERVICE_HOST', '0.0.0.0')
@@ -25,7 +39,24 @@ class AIServiceConfig:
     # 分析配置
     BATCH_SIZE_LIMIT: int = int(os.getenv('BATCH_SIZE_LIMIT', '50'))
     ANALYSIS_TIMEOUT: int = int(os.getenv('ANALYSIS_TIMEOUT', '30'))
-    
+    ANALYSIS_CONCURRENCY: int = int(os.getenv('ANALYSIS_CONCURRENCY', '5'))  # 批量分析同时进行的上游调用数
+
+    # 原始邮件导入配置
+    INGEST_MAX_ATTACHMENT_BYTES: int = int(os.getenv('INGEST_MAX_ATTACHMENT_BYTES', str(1024 * 1024)))  # 1MB
+    INGEST_MAX_MESSAGE_BYTES: int = int(os.getenv('INGEST_MAX_MESSAGE_BYTES', str(25 * 1024 * 1024)))  # 25MB，超出部分不解析
+    INGEST_MAX_RETURNED_RESULTS: int = int(os.getenv('INGEST_MAX_RETURNED_RESULTS', '100'))  # 导入接口最多返回的结果数
+
+    # 请求追踪与调试配置
+    TRACE_SLOW_REQUESTS: int = int(os.getenv('TRACE_SLOW_REQUESTS', '20'))  # 保留最慢的请求数
+    TRACE_PROFILE_HISTORY: int = int(os.getenv('TRACE_PROFILE_HISTORY', '10'))  # 保留最近的剖析结果数
+    SLOW_REQUEST_MS: float = float(os.getenv('SLOW_REQUEST_MS', '3000'))  # 超过该耗时记录告警日志
+    DEBUG_TOKEN: Optional[str] = os.getenv('DEBUG_TOKEN')  # 设置后调试接口凭 X-Debug-Token 请求头访问
+    DEBUG_ENDPOINTS_ENABLED: bool = os.getenv('DEBUG_ENDPOINTS_ENABLED', 'false').lower() == 'true'  # 未设置 DEBUG_TOKEN 时是否开放调试接口，仅限本地开发
+
+    # 全文索引配置
+    SEARCH_INDEX_PATH: str = os.getenv('SEARCH_INDEX_PATH', 'data/search_index.jsonl')  # 留空则只保存在内存
+    SEARCH_TOP_K: int = int(os.getenv('SEARCH_TOP_K', '5'))  # 聊天检索的邮件数
+
     # 缓存配置
     CACHE_TTL: int = int(os.getenv('CACHE_TTL', '3600'))  # 1小时
     
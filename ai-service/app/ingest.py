@@ -0,0 +1,345 @@
+# 原始邮件（RFC822 / mbox）流式导入
+"""
+将原始 RFC822 邮件或整个 mbox 文件解析为分析引擎可用的邮件字典。
+
+文件通过 mmap 映射后以生成器流水线逐封解析，任意时刻只持有当前一封邮件，
+导入数 GB 的归档也不会整体读入内存。单封邮件超过 INGEST_MAX_MESSAGE_BYTES 时
+只解析前面部分（正文通常在大附件之前），单封邮件的内存占用同样有上限。
+
+命令行用法（在 ai-service 目录下）：
+    python -m app.ingest archive.mbox message.eml [--dry-run]
+"""
+
+import argparse
+import hashlib
+import html
+import json
+import mmap
+import os
+import re
+import sys
+from email import message_from_bytes
+from email.header import decode_header
+from email.message import Message
+from email.policy import compat32
+from email.utils import parsedate_to_datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .config import config
+
+# mbox 分隔行："From " 开头，且位于文件开头或空行之后
+_MBOX_FROM_LINE = re.compile(rb"^From ", re.MULTILINE)
+# mboxrd 转义：正文中的 ">From " 行需去掉一层 ">"
+_MBOXRD_ESCAPED = re.compile(rb"^>(>*From )", re.MULTILINE)
+_HTML_TAG = re.compile(r"<[^>]+>")
+_HTML_SKIP_BLOCK = re.compile(r"<(script|style)\b.*?</\1\s*>", re.IGNORECASE | re.DOTALL)
+_BLANK_LINES = re.compile(r"\n\s*\n+")
+# 文件开头可忽略的 UTF-8 BOM 和空白
+_LEADING_BLANK = b"\xef\xbb\xbf \t\r\n"
+# 格式识别只查看文件开头这么多字节
+_DETECT_BYTES = 4096
+
+# 国内邮件常见的 GB2312/GBK 声明统一按超集 GB18030 解码，避免声明与实际编码不符导致乱码
+_CHARSET_ALIASES = {
+    "gb2312": "gb18030",
+    "gb_2312-80": "gb18030",
+    "euc-cn": "gb18030",
+    "gbk": "gb18030",
+    "x-gbk": "gb18030",
+    "cp936": "gb18030",
+    "ms936": "gb18030",
+    # 未声明编码的 8bit 邮件头，交给自动探测
+    "unknown-8bit": None,
+}
+
+
+class IngestStats:
+    """导入过程统计"""
+
+    def __init__(self):
+        self.files = 0
+        self.messages = 0
+        self.parse_errors = 0
+        self.attachments_skipped = 0
+        self.bytes_scanned = 0
+        self.analysis_errors = 0
+        self.messages_truncated = 0
+
+    def to_dict(self) -> dict:
+        return {
+            "files": self.files,
+            "messages": self.messages,
+            "parse_errors": self.parse_errors,
+            "analysis_errors": self.analysis_errors,
+            "messages_truncated": self.messages_truncated,
+            "attachments_skipped": self.attachments_skipped,
+            "bytes_scanned": self.bytes_scanned,
+        }
+
+
+def normalize_charset(charset: Optional[str]) -> Optional[str]:
+    """规范化字符集名称"""
+    if not charset:
+        return None
+    charset = charset.strip().strip('"').lower()
+    return _CHARSET_ALIASES.get(charset, charset)
+
+
+def decode_bytes(data: bytes, charset: Optional[str] = None) -> str:
+    """按声明的字符集解码，未声明或声明无效时依次尝试 UTF-8 与 GB18030"""
+    charset = normalize_charset(charset)
+    if charset:
+        try:
+            return data.decode(charset, errors="replace")
+        except LookupError:
+            pass
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return data.decode("gb18030", errors="replace")
+
+
+def decode_header_value(value) -> str:
+    """解码 RFC2047 编码的邮件头，兼容直接写入 8bit GBK 的邮件头"""
+    if value is None:
+        return ""
+    parts = []
+    try:
+        fragments = decode_header(value)
+    except Exception:
+        fragments = [(str(value), None)]
+    for fragment, charset in fragments:
+        if isinstance(fragment, bytes):
+            parts.append(decode_bytes(fragment, charset))
+        else:
+            parts.append(fragment)
+    text = "".join(parts)
+    # compat32 解析器会以 surrogateescape 保留未编码的 8bit 字节
+    try:
+        text.encode("utf-8")
+    except UnicodeEncodeError:
+        text = decode_bytes(text.encode("ascii", "surrogateescape"))
+    return " ".join(text.split())
+
+
+def _html_to_text(markup: str) -> str:
+    """将 HTML 正文粗略转换为纯文本"""
+    markup = _HTML_SKIP_BLOCK.sub(" ", markup)
+    markup = re.sub(r"(?i)<br\s*/?>|</p\s*>|</div\s*>", "\n", markup)
+    text = html.unescape(_HTML_TAG.sub(" ", markup))
+    return _BLANK_LINES.sub("\n\n", text).strip()
+
+
+def _encoded_payload_size(part: Message) -> int:
+    """未解码载荷的大小，用于在解码前判断附件是否超限"""
+    payload = part.get_payload()
+    return len(payload) if isinstance(payload, (str, bytes)) else 0
+
+
+def extract_body(msg: Message, stats: IngestStats, max_attachment_bytes: int) -> str:
+    """提取邮件正文：优先 text/plain，其次 HTML；超过大小上限的附件不解码直接跳过"""
+    plain_parts: List[str] = []
+    html_parts: List[str] = []
+
+    for part in msg.walk():
+        if part.is_multipart():
+            continue
+
+        is_attachment = part.get_content_disposition() == "attachment" or bool(part.get_filename())
+        if is_attachment:
+            # 附件只保留较小的文本附件，二进制附件无法参与分析
+            if part.get_content_maintype() != "text" or _encoded_payload_size(part) > max_attachment_bytes:
+                stats.attachments_skipped += 1
+                continue
+
+        content_type = part.get_content_type()
+        if content_type not in ("text/plain", "text/html"):
+            continue
+
+        payload = part.get_payload(decode=True)
+        if not payload:
+            continue
+        text = decode_bytes(payload, part.get_content_charset()).replace("\r\n", "\n")
+
+        if content_type == "text/html":
+            html_parts.append(_html_to_text(text))
+        else:
+            plain_parts.append(text.strip())
+
+    body_parts = plain_parts or html_parts
+    return "\n\n".join(p for p in body_parts if p)
+
+
+def fallback_email_id(raw: bytes) -> str:
+    """没有 Message-ID 时按原始内容生成稳定的邮件ID，重复导入同一归档不会产生重复邮件"""
+    return "raw-" + hashlib.sha1(raw).hexdigest()[:20]
+
+
+def parse_message(raw: bytes, stats: IngestStats,
+                  max_attachment_bytes: Optional[int] = None) -> Dict[str, str]:
+    """将一封原始邮件解析为分析请求字典（email_id/subject/content/sender，以及可解析时的 received_at）"""
+    if max_attachment_bytes is None:
+        max_attachment_bytes = config.INGEST_MAX_ATTACHMENT_BYTES
+
+    msg = message_from_bytes(raw, policy=compat32)
+    message_id = decode_header_value(msg.get("Message-ID")).strip("<> ")
+
+    email_data = {
+        "email_id": message_id or fallback_email_id(raw),
+        "subject": decode_header_value(msg.get("Subject")),
+        "content": extract_body(msg, stats, max_attachment_bytes),
+        "sender": decode_header_value(msg.get("From")),
+    }
+    try:
+        email_data["received_at"] = parsedate_to_datetime(decode_header_value(msg.get("Date"))).isoformat()
+    except (TypeError, ValueError, IndexError):
+        pass
+    return email_data
+
+
+def _content_start(buf) -> int:
+    """跳过文件开头的 BOM 和空行，返回内容起始位置"""
+    head = buf[:_DETECT_BYTES]
+    return len(head) - len(head.lstrip(_LEADING_BLANK))
+
+
+def detect_format(buf) -> str:
+    """按第一个非空行识别格式：以 From_ 行开头为 mbox，否则为单封邮件"""
+    start = _content_start(buf)
+    return "mbox" if buf[start:start + 5] == b"From " else "eml"
+
+
+def iter_mbox_spans(buf) -> Iterator[Tuple[int, int]]:
+    """在 mmap 缓冲区上按 From_ 分隔行切分 mbox，逐封返回 (起始, 结束) 偏移，不复制数据"""
+    first = _content_start(buf)
+    start = None
+    for match in _MBOX_FROM_LINE.finditer(buf):
+        pos = match.start()
+        if pos != first and buf[max(pos - 2, 0):pos] != b"\n\n" and buf[max(pos - 4, 0):pos] != b"\r\n\r\n":
+            continue
+        if start is not None:
+            yield start, pos
+        start = pos
+    if start is not None:
+        yield start, len(buf)
+
+
+def _read_capped(buf, start: int, end: int, limit: int, stats: IngestStats) -> bytes:
+    """复制一封邮件的原始字节，超过上限的部分直接丢弃"""
+    if end - start > limit:
+        stats.messages_truncated += 1
+        end = start + limit
+    return buf[start:end]
+
+
+def _strip_from_line(raw: bytes) -> bytes:
+    """去掉 mbox 的 From_ 行并还原 mboxrd 转义"""
+    newline = raw.find(b"\n")
+    raw = raw[newline + 1:] if newline != -1 else b""
+    return _MBOXRD_ESCAPED.sub(rb"\1", raw)
+
+
+def iter_raw_messages(path: str, stats: IngestStats, fmt: str = "auto",
+                      max_message_bytes: Optional[int] = None) -> Iterator[bytes]:
+    """映射单个文件并逐封产出原始字节（每封不超过 max_message_bytes）。fmt 取值 auto/mbox/eml"""
+    if max_message_bytes is None:
+        max_message_bytes = config.INGEST_MAX_MESSAGE_BYTES
+    stats.files += 1
+    if os.path.getsize(path) == 0:
+        return
+
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        stats.bytes_scanned += len(mm)
+        if fmt == "auto":
+            fmt = detect_format(mm)
+
+        if fmt == "mbox":
+            spans = iter_mbox_spans(mm)
+            try:
+                for start, end in spans:
+                    yield _strip_from_line(_read_capped(mm, start, end, max_message_bytes, stats))
+            finally:
+                # 先释放正则扫描器对 mmap 的引用，否则关闭映射会报 BufferError
+                spans.close()
+        else:
+            yield _read_capped(mm, _content_start(mm), len(mm), max_message_bytes, stats)
+
+
+def iter_emails(paths: Iterable[str], stats: IngestStats, fmt: str = "auto",
+                max_attachment_bytes: Optional[int] = None,
+                max_message_bytes: Optional[int] = None) -> Iterator[Dict[str, str]]:
+    """解析流水线：文件 -> 原始邮件 -> 分析请求字典，单封解析失败只计数不中断"""
+    for path in paths:
+        for raw in iter_raw_messages(path, stats, fmt, max_message_bytes):
+            try:
+                email_data = parse_message(raw, stats, max_attachment_bytes)
+            except Exception:
+                stats.parse_errors += 1
+                continue
+            stats.messages += 1
+            yield email_data
+
+
+def iter_batches(items: Iterable[dict], size: int) -> Iterator[List[dict]]:
+    """将流水线输出按批次大小分组"""
+    batch: List[dict] = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def _run_cli(args: argparse.Namespace) -> int:
+    stats = IngestStats()
+    emails = iter_emails(args.paths, stats, args.format, args.max_attachment_bytes, args.max_message_bytes)
+
+    if args.dry_run:
+        for email_data in emails:
+            print(json.dumps(email_data, ensure_ascii=False))
+        print(json.dumps({"ingest_stats": stats.to_dict()}, ensure_ascii=False), file=sys.stderr)
+        return 0
+
+    # 延迟导入，避免 dry-run 依赖 Web 框架
+    from .main import EmailAnalysisRequest, SummaryStats, analyze_email_batch
+
+    # 结果逐批输出后即丢弃，只保留汇总计数
+    summary = SummaryStats()
+    for batch in iter_batches(emails, args.batch_size):
+        batch_results = await analyze_email_batch(
+            [EmailAnalysisRequest(**e, user_id=args.user_id) for e in batch], stats
+        )
+        for analysis in batch_results:
+            print(json.dumps(analysis.model_dump(), ensure_ascii=False))
+        summary.add(batch_results)
+
+    print(json.dumps({
+        "summary_stats": summary.to_dict(),
+        "ingest_stats": stats.to_dict(),
+    }, ensure_ascii=False), file=sys.stderr)
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """命令行入口"""
+    import asyncio
+
+    parser = argparse.ArgumentParser(description="批量导入原始 RFC822/mbox 邮件并进行AI分析")
+    parser.add_argument("paths", nargs="+", help="mbox 或 .eml 文件路径")
+    parser.add_argument("--format", choices=["auto", "mbox", "eml"], default="auto", help="文件格式（默认自动识别）")
+    parser.add_argument("--batch-size", type=int, default=config.BATCH_SIZE_LIMIT, help="每批分析的邮件数")
+    parser.add_argument("--max-attachment-bytes", type=int, default=config.INGEST_MAX_ATTACHMENT_BYTES,
+                        help="文本附件的大小上限，超出则跳过")
+    parser.add_argument("--max-message-bytes", type=int, default=config.INGEST_MAX_MESSAGE_BYTES,
+                        help="单封邮件的解析上限，超出部分丢弃")
+    parser.add_argument("--user-id", help="邮件所属用户，指定后分析结果写入该用户的全文索引")
+    parser.add_argument("--dry-run", action="store_true", help="只解析并输出邮件，不调用AI分析")
+    args = parser.parse_args(argv)
+
+    return asyncio.run(_run_cli(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,17 +1,23 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, Header, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import List, Optional
 import os
 from datetime import datetime
 import openai
+import asyncio
+import hmac
 import logging
-from dotenv import load_dotenv
 import json
-import asyncio
+import tempfile
+import time
+import aiofiles
 
-# 加载环境变量
-load_dotenv()
+from .config import config
+from .ingest import IngestStats, iter_batches, iter_emails
+from .tokens import InputTooLargeError, plan_request, preload_encodings, usage_tracker
+from .search import search_index
+from .tracing import TracedRoute, TracingMiddleware, run_in_executor_traced, span, tracer
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -27,6 +33,8 @@ app = FastAPI(
     description="智能邮件分析和AI助手服务",
     version="1.0.0"
 )
+# 所有路由处理函数自动标记开始/结束，用于区分请求校验和响应编码阶段
+app.router.route_class = TracedRoute
 
 # 配置 CORS
 app.add_middleware(
@@ -37,12 +45,17 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 请求分阶段计时（最外层，覆盖整个请求）
+app.add_middleware(TracingMiddleware)
+
 # 数据模型
 class EmailAnalysisRequest(BaseModel):
     email_id: str
     subject: str
     content: str
     sender: str
+    received_at: Optional[datetime] = None
+    user_id: Optional[str] = None  # 邮件所属用户，未指定时不写入全文索引
 
 class EmailAnalysisResponse(BaseModel):
     email_id: str
@@ -54,15 +67,20 @@ class EmailAnalysisResponse(BaseModel):
     confidence: float = 0.0
     key_points: List[str] = []
     action_required: bool = False
+    token_usage: Optional[dict] = None
 
 class ChatMessage(BaseModel):
     message: str
     context: Optional[str] = None
+    top_k: Optional[int] = Field(None, ge=0, le=100)  # 检索的相关邮件数，0 为不检索
+    user_id: Optional[str] = None  # 只检索该用户的邮件，未指定时不检索
 
 class ChatResponse(BaseModel):
     reply: str
     timestamp: str
     suggestions: List[str] = []
+    token_usage: Optional[dict] = None
+    references: List[dict] = []
 
 class EmailBatch(BaseModel):
     emails: List[EmailAnalysisRequest]
@@ -71,6 +89,22 @@ class BatchAnalysisResponse(BaseModel):
     results: List[EmailAnalysisResponse]
     summary_stats: dict
 
+class IngestResponse(BaseModel):
+    results: List[EmailAnalysisResponse]
+    results_truncated: bool = False
+    summary_stats: dict
+    ingest_stats: dict
+
+class ProfilingSettings(BaseModel):
+    sample_rate: float = Field(..., ge=0, le=1)  # 0 为关闭
+    top_n: Optional[int] = Field(None, ge=1)
+
+class SearchResponse(BaseModel):
+    query: str
+    results: List[dict]
+    indexed_emails: int
+    took_ms: float
+
 class HealthResponse(BaseModel):
     status: str
     timestamp: str
@@ -86,6 +120,26 @@ async def root():
         "docs": "/docs"
     }
 
+@app.on_event("startup")
+async def load_search_index():
+    """启动时从日志恢复全文索引"""
+    search_index.load()
+
+@app.on_event("startup")
+async def load_tokenizer():
+    """在线程池中预加载 tiktoken 编码，超时不阻塞启动，加载完成前按估算计数"""
+    future = asyncio.get_event_loop().run_in_executor(
+        None, preload_encodings, [config.OPENAI_MODEL, config.OPENAI_FAST_MODEL]
+    )
+    try:
+        await asyncio.wait_for(asyncio.shield(future), timeout=config.TOKENIZER_LOAD_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"tiktoken 编码 {config.TOKENIZER_LOAD_TIMEOUT}s 内未加载完成，暂时使用估算计数")
+
+@app.on_event("shutdown")
+async def close_search_index():
+    search_index.close()
+
 @app.get("/health", response_model=HealthResponse)
 async def health_check():
     """健康检查端点"""
@@ -108,17 +162,18 @@ async def get_openai_analysis(subject: str, content: str, sender: str) -> dict:
             "tags": ["工作", "待回复"],
             "confidence": 0.7,
             "key_points": ["需要回复", "查看详情"],
-            "action_required": True
+            "action_required": True,
+            "mock": True
         }
     
-    try:
+    def build_messages(body: str) -> List[dict]:
         # 构建提示词
         prompt = f"""
         请分析以下邮件内容并提供结构化分析：
         
         发件人：{sender}
         主题：{subject}
-        内容：{content}
+        内容：{body}
         
         请提供以下分析（用JSON格式返回）：
         1. summary: 邮件内容摘要（50字以内）
@@ -130,27 +185,39 @@ async def get_openai_analysis(subject: str, content: str, sender: str) -> dict:
         7. key_points: 关键要点（最多3个）
         8. action_required: 是否需要行动（true/false）
         """
-        
-        response = await asyncio.get_event_loop().run_in_executor(
-            None,
+        return [
+            {"role": "system", "content": "你是一个专业的邮件分析助手，能够准确分析邮件内容并提供有用的建议。请用JSON格式返回分析结果。"},
+            {"role": "user", "content": prompt}
+        ]
+    
+    # 调用前预检 token，超长正文按策略裁剪或抛出 InputTooLargeError
+    try:
+        with span("prompt_build"):
+            messages, plan = plan_request("analysis", build_messages, content, config.OPENAI_MAX_TOKENS)
+    except InputTooLargeError as e:
+        usage_tracker.record_rejected("analysis", e)
+        raise
+    
+    try:
+        response = await run_in_executor_traced(
+            "upstream_call",
             lambda: openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "你是一个专业的邮件分析助手，能够准确分析邮件内容并提供有用的建议。请用JSON格式返回分析结果。"},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=500,
-                temperature=0.3
+                model=plan.model,
+                messages=messages,
+                max_tokens=plan.max_tokens,
+                temperature=config.OPENAI_TEMPERATURE
             )
         )
+        usage_tracker.record(plan, response.get("usage"))
         
         result = response.choices[0].message.content
         # 尝试解析JSON响应
         try:
-            return json.loads(result)
+            with span("json_parse"):
+                analysis = json.loads(result)
         except json.JSONDecodeError:
             # 如果解析失败，返回默认结构
-            return {
+            analysis = {
                 "summary": f"邮件主题：{subject}",
                 "priority": "medium",
                 "sentiment": "neutral",
@@ -158,8 +225,11 @@ async def get_openai_analysis(subject: str, content: str, sender: str) -> dict:
                 "tags": ["AI分析"],
                 "confidence": 0.5,
                 "key_points": ["需要人工审查"],
-                "action_required": False
+                "action_required": False,
+                "fallback": True
             }
+        analysis["token_usage"] = plan.to_dict()
+        return analysis
     except Exception as e:
         logger.error(f"OpenAI API调用失败: {str(e)}")
         return {
@@ -170,46 +240,87 @@ async def get_openai_analysis(subject: str, content: str, sender: str) -> dict:
             "tags": ["分析失败"],
             "confidence": 0.0,
             "key_points": ["AI分析不可用"],
-            "action_required": False
+            "action_required": False,
+            "fallback": True
         }
 
-async def get_ai_chat_response(message: str, context: str = None) -> dict:
-    """AI聊天功能"""
+def format_references(references: List[dict]) -> str:
+    """将检索到的邮件整理为提示词中的上下文"""
+    lines = []
+    for i, ref in enumerate(references, 1):
+        received = (ref.get("received_at") or "")[:10]
+        tags = "、".join(ref.get("tags", []))
+        lines.append(f"{i}. [{ref['priority']}] {received} {ref['subject']}：{ref['summary']}（标签：{tags}，ID：{ref['email_id']}）")
+    return "\n".join(lines)
+
+async def get_ai_chat_response(message: str, context: str = None, top_k: Optional[int] = None,
+                               user_id: Optional[str] = None) -> dict:
+    """AI聊天功能，先从该用户的全文索引检索相关邮件作为回答依据"""
+    top_k = config.SEARCH_TOP_K if top_k is None else top_k
+    references = []
+    if top_k > 0 and user_id:
+        with span("retrieval"):
+            references = search_index.search(message, user_id, top_k)
+    
     if not openai.api_key:
         # 模拟AI回复
-        if "邮件" in message:
+        if references:
             return {
-                "reply": "我可以帮您分析和管理邮件。您想了解什么具体信息？",
-                "suggestions": ["查看未读邮件", "邮件统计", "优先级邮件"]
+                "reply": f"为您找到 {len(references)} 封相关邮件：\n{format_references(references)}",
+                "suggestions": ["查看邮件详情", "生成回复", "标记已处理"],
+                "references": references
             }
         elif "统计" in message:
+            stats = search_index.stats(user_id)
+            priorities = stats["priority_distribution"]
             return {
-                "reply": "根据最新数据，您有25封未读邮件，其中5封是高优先级的。",
+                "reply": f"目前已分析 {stats['indexed_emails']} 封邮件，其中高优先级 {priorities['high']} 封、中优先级 {priorities['medium']} 封、低优先级 {priorities['low']} 封。",
                 "suggestions": ["查看高优先级", "批量处理", "设置提醒"]
             }
+        elif "邮件" in message:
+            return {
+                "reply": "我可以帮您分析和管理邮件。您想了解什么具体信息？",
+                "suggestions": ["查看未读邮件", "邮件统计", "优先级邮件"]
+            }
         else:
             return {
                 "reply": "我是您的AI邮件助手，可以帮您管理邮件、分析内容和提供建议。",
                 "suggestions": ["邮件分析", "智能回复", "邮件统计"]
             }
     
-    try:
+    def build_messages(body: str) -> List[dict]:
         system_message = "你是一个专业的邮件管理助手，可以帮助用户分析邮件、提供建议和回答相关问题。请用中文回复，语气友好专业。"
-        if context:
-            system_message += f" 上下文信息：{context}"
-        
-        response = await asyncio.get_event_loop().run_in_executor(
-            None,
+        if body:
+            system_message += f" 上下文信息：{body}"
+        return [
+            {"role": "system", "content": system_message},
+            {"role": "user", "content": message}
+        ]
+    
+    # 检索到的邮件和调用方上下文是可裁剪的正文，用户消息本身计入固定开销
+    body_parts = []
+    if references:
+        body_parts.append(f"以下是与问题相关的邮件，请据此回答，不要编造邮件中没有的信息：\n{format_references(references)}")
+    if context:
+        body_parts.append(context)
+    try:
+        with span("prompt_build"):
+            messages, plan = plan_request("chat", build_messages, "\n".join(body_parts), config.CHAT_MAX_TOKENS)
+    except InputTooLargeError as e:
+        usage_tracker.record_rejected("chat", e)
+        raise
+    
+    try:
+        response = await run_in_executor_traced(
+            "upstream_call",
             lambda: openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": system_message},
-                    {"role": "user", "content": message}
-                ],
-                max_tokens=300,
+                model=plan.model,
+                messages=messages,
+                max_tokens=plan.max_tokens,
                 temperature=0.7
             )
         )
+        usage_tracker.record(plan, response.get("usage"))
         
         reply = response.choices[0].message.content
         
@@ -224,7 +335,9 @@ async def get_ai_chat_response(message: str, context: str = None) -> dict:
         
         return {
             "reply": reply,
-            "suggestions": suggestions
+            "suggestions": suggestions,
+            "token_usage": plan.to_dict(),
+            "references": references
         }
     except Exception as e:
         logger.error(f"AI聊天失败: {str(e)}")
@@ -246,70 +359,185 @@ async def analyze_email(request: EmailAnalysisRequest):
         )
         
         # 构建响应
-        analysis = EmailAnalysisResponse(
-            email_id=request.email_id,
-            summary=ai_result.get("summary", "未知内容"),
-            priority=ai_result.get("priority", "medium"),
-            sentiment=ai_result.get("sentiment", "neutral"),
-            suggested_reply=ai_result.get("suggested_reply"),
-            tags=ai_result.get("tags", []),
-            confidence=ai_result.get("confidence", 0.0),
-            key_points=ai_result.get("key_points", []),
-            action_required=ai_result.get("action_required", False)
-        )
+        analysis = build_analysis_response(request.email_id, ai_result)
+        if is_indexable(ai_result):
+            index_analysis(request, analysis)
         
         logger.info(f"邮件分析完成: {request.email_id}, 优先级: {analysis.priority}")
         return analysis
         
+    except InputTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
         logger.error(f"分析邮件时出错: {str(e)}")
         raise HTTPException(status_code=500, detail=f"分析邮件时出错: {str(e)}")
 
+# 模型返回的优先级/情感不一定在约定取值内，常见写法映射到约定值
+_PRIORITY_ALIASES = {
+    "urgent": "high", "critical": "high", "important": "high", "高": "high", "紧急": "high", "重要": "high",
+    "normal": "medium", "中": "medium", "一般": "medium", "普通": "medium",
+    "低": "low", "不重要": "low",
+}
+_SENTIMENT_ALIASES = {
+    "积极": "positive", "正面": "positive",
+    "中性": "neutral", "中立": "neutral",
+    "消极": "negative", "负面": "negative",
+}
+
+def _normalize_choice(value, allowed: tuple, aliases: dict, default: str) -> str:
+    text = str(value).strip().lower() if value is not None else ""
+    if text in allowed:
+        return text
+    return aliases.get(text, default)
+
+def _normalize_list(value) -> List[str]:
+    if value is None:
+        return []
+    if not isinstance(value, (list, tuple)):
+        value = [value]
+    return [str(item).strip() for item in value if item is not None and str(item).strip()]
+
+def _normalize_confidence(value) -> float:
+    try:
+        return min(max(float(value), 0.0), 1.0)
+    except (TypeError, ValueError):
+        return 0.0
+
+def _normalize_bool(value) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ("true", "yes", "1", "是")
+    return bool(value)
+
+def build_analysis_response(email_id: str, ai_result: dict) -> EmailAnalysisResponse:
+    """将AI分析结果转换为响应模型，不符合约定格式的字段按默认值修正"""
+    summary = ai_result.get("summary")
+    suggested_reply = ai_result.get("suggested_reply")
+    token_usage = ai_result.get("token_usage")
+    return EmailAnalysisResponse(
+        email_id=email_id,
+        summary=str(summary) if summary is not None else "未知内容",
+        priority=_normalize_choice(ai_result.get("priority"), ("high", "medium", "low"), _PRIORITY_ALIASES, "medium"),
+        sentiment=_normalize_choice(ai_result.get("sentiment"), ("positive", "neutral", "negative"), _SENTIMENT_ALIASES, "neutral"),
+        suggested_reply=str(suggested_reply) if suggested_reply is not None else None,
+        tags=_normalize_list(ai_result.get("tags")),
+        confidence=_normalize_confidence(ai_result.get("confidence", 0.0)),
+        key_points=_normalize_list(ai_result.get("key_points")),
+        action_required=_normalize_bool(ai_result.get("action_required", False)),
+        token_usage=token_usage if isinstance(token_usage, dict) else None
+    )
+
+def is_indexable(ai_result: dict) -> bool:
+    """只有真实的AI分析结果写入索引；占位结果和模拟结果会让聊天引用编造的内容"""
+    return not ai_result.get("fallback") and not ai_result.get("mock")
+
+def index_analysis(email_req: EmailAnalysisRequest, analysis: EmailAnalysisResponse):
+    """将分析结果写入所属用户的全文索引，未指定用户的邮件无法检索，不写入"""
+    if not email_req.user_id:
+        return
+    with span("index_update"):
+        search_index.add(
+            email_req.user_id,
+            email_req.email_id,
+            email_req.subject,
+            analysis.summary,
+            analysis.tags,
+            analysis.key_points,
+            analysis.priority,
+            email_req.received_at
+        )
+
+async def analyze_email_batch(emails: List[EmailAnalysisRequest],
+                              stats: Optional[IngestStats] = None) -> List[EmailAnalysisResponse]:
+    """批量分析引擎，供批量接口和原始邮件导入共用
+    
+    最多 ANALYSIS_CONCURRENCY 封邮件同时分析；单封邮件出错只产生占位结果，不影响同批次
+    其他邮件，未能完成分析的邮件数计入 stats.analysis_errors。
+    """
+    semaphore = asyncio.Semaphore(config.ANALYSIS_CONCURRENCY)
+    
+    async def analyze_one(email_req: EmailAnalysisRequest):
+        async with semaphore:
+            try:
+                ai_result = await get_openai_analysis(email_req.subject, email_req.content, email_req.sender)
+                analysis = build_analysis_response(email_req.email_id, ai_result)
+                if ai_result.get("fallback") and stats is not None:
+                    stats.analysis_errors += 1
+                return ai_result, analysis
+            except InputTooLargeError as e:
+                if stats is not None:
+                    stats.analysis_errors += 1
+                ai_result = {
+                    "summary": "邮件内容过长，未进行AI分析",
+                    "tags": ["内容过长"],
+                    "confidence": 0.0,
+                    "key_points": [str(e)],
+                    "fallback": True
+                }
+            except Exception as e:
+                logger.error(f"邮件分析失败: {email_req.email_id}, {str(e)}")
+                if stats is not None:
+                    stats.analysis_errors += 1
+                ai_result = {
+                    "summary": f"邮件来自{email_req.sender}，主题：{email_req.subject}",
+                    "tags": ["分析失败"],
+                    "confidence": 0.0,
+                    "key_points": ["AI分析结果无法解析"],
+                    "fallback": True
+                }
+            return ai_result, build_analysis_response(email_req.email_id, ai_result)
+    
+    analyzed = await asyncio.gather(*(analyze_one(email_req) for email_req in emails))
+    
+    # 按输入顺序写入索引，同批次重复的邮件以后一封为准
+    results = []
+    for email_req, (ai_result, analysis) in zip(emails, analyzed):
+        # 占位结果不写入索引，避免覆盖同一封邮件此前的有效分析
+        if is_indexable(ai_result):
+            index_analysis(email_req, analysis)
+        results.append(analysis)
+    return results
+
+class SummaryStats:
+    """逐批累计分析结果的统计，无需保留全部结果"""
+    
+    def __init__(self):
+        self.total = 0
+        self.priorities = {"high": 0, "medium": 0, "low": 0}
+        self.sentiments = {"positive": 0, "neutral": 0, "negative": 0}
+        self.action_required = 0
+        self.confidence_sum = 0.0
+    
+    def add(self, results: List[EmailAnalysisResponse]):
+        for analysis in results:
+            self.total += 1
+            self.priorities[analysis.priority] += 1
+            self.sentiments[analysis.sentiment] += 1
+            self.action_required += 1 if analysis.action_required else 0
+            self.confidence_sum += analysis.confidence
+    
+    def to_dict(self) -> dict:
+        return {
+            "total_emails": self.total,
+            "priority_distribution": self.priorities,
+            "sentiment_distribution": self.sentiments,
+            "action_required_count": self.action_required,
+            "avg_confidence": self.confidence_sum / self.total if self.total else 0
+        }
+
+def build_summary_stats(results: List[EmailAnalysisResponse]) -> dict:
+    """汇总批量分析结果"""
+    summary = SummaryStats()
+    summary.add(results)
+    return summary.to_dict()
+
 @app.post("/analyze/batch", response_model=BatchAnalysisResponse)
 async def analyze_batch_emails(batch: EmailBatch):
     """批量分析邮件"""
     try:
         logger.info(f"开始批量分析 {len(batch.emails)} 封邮件")
         
-        results = []
-        priorities = {"high": 0, "medium": 0, "low": 0}
-        sentiments = {"positive": 0, "neutral": 0, "negative": 0}
-        
-        # 并发处理多封邮件
-        tasks = []
-        for email_req in batch.emails:
-            task = get_openai_analysis(email_req.subject, email_req.content, email_req.sender)
-            tasks.append((email_req.email_id, task))
-        
-        # 等待所有分析完成
-        for email_id, task in tasks:
-            ai_result = await task
-            
-            analysis = EmailAnalysisResponse(
-                email_id=email_id,
-                summary=ai_result.get("summary", "未知内容"),
-                priority=ai_result.get("priority", "medium"),
-                sentiment=ai_result.get("sentiment", "neutral"),
-                suggested_reply=ai_result.get("suggested_reply"),
-                tags=ai_result.get("tags", []),
-                confidence=ai_result.get("confidence", 0.0),
-                key_points=ai_result.get("key_points", []),
-                action_required=ai_result.get("action_required", False)
-            )
-            
-            results.append(analysis)
-            
-            # 统计信息
-            priorities[analysis.priority] += 1
-            sentiments[analysis.sentiment] += 1
-        
-        summary_stats = {
-            "total_emails": len(results),
-            "priority_distribution": priorities,
-            "sentiment_distribution": sentiments,
-            "action_required_count": sum(1 for r in results if r.action_required),
-            "avg_confidence": sum(r.confidence for r in results) / len(results) if results else 0
-        }
+        results = await analyze_email_batch(batch.emails)
+        summary_stats = build_summary_stats(results)
         
         logger.info(f"批量分析完成: {len(results)} 封邮件")
         return BatchAnalysisResponse(results=results, summary_stats=summary_stats)
@@ -317,6 +545,74 @@ async def analyze_batch_emails(batch: EmailBatch):
     except Exception as e:
         logger.error(f"批量分析失败: {str(e)}")
         raise HTTPException(status_code=500, detail=f"批量分析失败: {str(e)}")
+
+@app.post("/ingest/raw", response_model=IngestResponse)
+async def ingest_raw_emails(request: Request, format: str = "auto", include_results: bool = False,
+                            user_id: Optional[str] = None):
+    """导入原始 RFC822 邮件或 mbox 文件并批量分析
+    
+    请求体为原始文件内容，边接收边写入临时文件，再通过 mmap 流式解析，
+    上传和解析都不会把整个归档读入内存。统计逐批累计，分析结果写入全文索引后即丢弃；
+    include_results 为 true 时最多返回前 INGEST_MAX_RETURNED_RESULTS 条结果。
+    user_id 为邮件所属用户，未指定时分析结果不写入全文索引。
+    """
+    if format not in ("auto", "mbox", "eml"):
+        raise HTTPException(status_code=400, detail=f"不支持的格式: {format}")
+    
+    fd, tmp_path = tempfile.mkstemp(prefix="ingest-", suffix=".mbox")
+    os.close(fd)
+    try:
+        # 分块写入临时文件
+        received = 0
+        with span("upload"):
+            async with aiofiles.open(tmp_path, "wb") as f:
+                async for chunk in request.stream():
+                    if chunk:
+                        await f.write(chunk)
+                        received += len(chunk)
+        if received == 0:
+            raise HTTPException(status_code=400, detail="请求体为空")
+        
+        logger.info(f"开始导入原始邮件: {received} 字节, 格式: {format}")
+        
+        stats = IngestStats()
+        batches = iter_batches(iter_emails([tmp_path], stats, format), config.BATCH_SIZE_LIMIT)
+        summary = SummaryStats()
+        results = []
+        results_truncated = False
+        try:
+            while True:
+                # 解析属于CPU密集操作，放到线程池中逐批推进生成器
+                batch = await run_in_executor_traced("ingest_parse", next, batches, None)
+                if batch is None:
+                    break
+                batch_results = await analyze_email_batch(
+                    [EmailAnalysisRequest(**e, user_id=user_id) for e in batch], stats
+                )
+                summary.add(batch_results)
+                if include_results:
+                    room = config.INGEST_MAX_RETURNED_RESULTS - len(results)
+                    results.extend(batch_results[:max(room, 0)])
+                    results_truncated = results_truncated or len(batch_results) > room
+        finally:
+            batches.close()
+        
+        logger.info(f"原始邮件导入完成: {stats.messages} 封邮件, 解析失败 {stats.parse_errors} 封")
+        return IngestResponse(
+            results=results,
+            results_truncated=results_truncated,
+            summary_stats=summary.to_dict(),
+            ingest_stats=stats.to_dict()
+        )
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"原始邮件导入失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"原始邮件导入失败: {str(e)}")
+    finally:
+        os.remove(tmp_path)
+
 @app.get("/stats/summary")
 async def get_email_stats():
     """获取邮件统计信息"""
@@ -334,6 +630,66 @@ async def get_email_stats():
         "ai_analysis_status": "active" if openai.api_key else "mock_mode"
     }
 
+@app.get("/search", response_model=SearchResponse)
+async def search_emails(q: str, k: int = 10, user_id: Optional[str] = None):
+    """在某个用户已分析邮件的全文索引中检索，未指定用户时不返回结果"""
+    if k < 1 or k > 100:
+        raise HTTPException(status_code=400, detail="k 的取值范围为 1-100")
+    start = time.perf_counter()
+    with span("retrieval"):
+        results = search_index.search(q, user_id, k)
+    return SearchResponse(
+        query=q,
+        results=results,
+        indexed_emails=search_index.stats(user_id)["indexed_emails"],
+        took_ms=round((time.perf_counter() - start) * 1000, 3)
+    )
+
+@app.get("/stats/tokens")
+async def get_token_stats():
+    """获取 token 用量统计"""
+    return usage_tracker.to_dict()
+
+# 调试接口
+def require_debug_token(x_debug_token: Optional[str] = Header(None)):
+    """调试接口默认关闭：配置 DEBUG_TOKEN 后凭请求头访问，或显式开启 DEBUG_ENDPOINTS_ENABLED"""
+    if config.DEBUG_TOKEN:
+        # 常量时间比较，避免通过响应耗时逐位猜出令牌
+        if not x_debug_token or not hmac.compare_digest(x_debug_token.encode(), config.DEBUG_TOKEN.encode()):
+            raise HTTPException(status_code=403, detail="调试接口需要有效的 X-Debug-Token")
+    elif not config.DEBUG_ENDPOINTS_ENABLED:
+        raise HTTPException(status_code=403, detail="调试接口未启用")
+
+@app.get("/debug/slow-requests", dependencies=[Depends(require_debug_token)])
+async def get_slow_requests():
+    """最慢的 N 个请求及其阶段耗时"""
+    return {
+        "settings": tracer.settings(),
+        "requests": tracer.slowest()
+    }
+
+@app.get("/debug/profiles", dependencies=[Depends(require_debug_token)])
+async def get_profiles():
+    """最近被抽样剖析的请求"""
+    return {"profiles": tracer.profiles()}
+
+@app.get("/debug/profiling", dependencies=[Depends(require_debug_token)])
+async def get_profiling():
+    """当前剖析配置"""
+    return tracer.settings()
+
+@app.put("/debug/profiling", dependencies=[Depends(require_debug_token)])
+async def update_profiling(settings: ProfilingSettings):
+    """运行时开启/关闭请求抽样剖析"""
+    tracer.set_profiling(settings.sample_rate, settings.top_n)
+    return tracer.settings()
+
+@app.delete("/debug/slow-requests", dependencies=[Depends(require_debug_token)])
+async def reset_slow_requests():
+    """清空已记录的慢请求和剖析结果"""
+    tracer.reset()
+    return tracer.settings()
+
 @app.post("/ai/chat", response_model=ChatResponse)
 async def ai_chat(message: ChatMessage):
     """AI聊天接口"""
@@ -341,17 +697,21 @@ async def ai_chat(message: ChatMessage):
         logger.info(f"AI聊天请求: {message.message[:50]}...")
         
         # 使用AI生成回复
-        chat_result = await get_ai_chat_response(message.message, message.context)
+        chat_result = await get_ai_chat_response(message.message, message.context, message.top_k, message.user_id)
         
         response = ChatResponse(
             reply=chat_result["reply"],
             timestamp=datetime.now().isoformat(),
-            suggestions=chat_result.get("suggestions", [])
+            suggestions=chat_result.get("suggestions", []),
+            token_usage=chat_result.get("token_usage"),
+            references=chat_result.get("references", [])
         )
         
         logger.info(f"AI回复生成成功")
         return response
         
+    except InputTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
         logger.error(f"AI聊天失败: {str(e)}")
         raise HTTPException(status_code=500, detail=f"AI聊天失败: {str(e)}")
@@ -370,12 +730,13 @@ async def generate_reply_suggestion(email_data: EmailAnalysisRequest):
                 ]
             }
         
-        prompt = f"""
+        def build_messages(body: str) -> List[dict]:
+            prompt = f"""
         请为以下邮件生成一个专业、得体的回复：
         
         发件人：{email_data.sender}
         主题：{email_data.subject}
-        内容：{email_data.content}
+        内容：{body}
         
         请提供：
         1. 一个主要的回复建议（100-200字）
@@ -384,30 +745,44 @@ async def generate_reply_suggestion(email_data: EmailAnalysisRequest):
         
         用JSON格式返回。
         """
+            return [
+                {"role": "system", "content": "你是一个专业的邮件回复助手，能够生成合适的回复内容。"},
+                {"role": "user", "content": prompt}
+            ]
         
-        response = await asyncio.get_event_loop().run_in_executor(
-            None,
+        try:
+            with span("prompt_build"):
+                messages, plan = plan_request("reply", build_messages, email_data.content, config.REPLY_MAX_TOKENS)
+        except InputTooLargeError as e:
+            usage_tracker.record_rejected("reply", e)
+            raise HTTPException(status_code=413, detail=str(e))
+        
+        response = await run_in_executor_traced(
+            "upstream_call",
             lambda: openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "你是一个专业的邮件回复助手，能够生成合适的回复内容。"},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=400,
+                model=plan.model,
+                messages=messages,
+                max_tokens=plan.max_tokens,
                 temperature=0.5
             )
         )
+        usage_tracker.record(plan, response.get("usage"))
         
         result = response.choices[0].message.content
         try:
-            return json.loads(result)
+            with span("json_parse"):
+                reply = json.loads(result)
         except json.JSONDecodeError:
-            return {
+            reply = {
                 "suggested_reply": "谢谢您的邮件，我会及时回复。",
                 "tone": "professional",
                 "alternatives": []
             }
+        reply["token_usage"] = plan.to_dict()
+        return reply
             
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"生成回复失败: {str(e)}")
         raise HTTPException(status_code=500, detail=f"生成回复失败: {str(e)}")
@@ -447,5 +822,5 @@ if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv('AI_SERVICE_PORT', 8001))
     logger.info(f"启动AI服务，端口: {port}")
-    logger.info(f"OpenAI API: {'\u5df2\u914d\u7f6e' if openai.api_key else '\u672a\u914d\u7f6e\uff08\u4f7f\u7528\u6a21\u62df\u6a21\u5f0f\uff09'}")
+    logger.info(f"OpenAI API: {'已配置' if openai.api_key else '未配置（使用模拟模式）'}")
     uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
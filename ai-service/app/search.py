@@ -0,0 +1,581 @@
+# 已分析邮件的本地全文索引
+"""
+基于 BM25 的倒排索引，覆盖已分析邮件的主题、摘要、标签和关键要点，
+供 /search 检索和 /ai/chat 检索增强使用。
+
+索引只追加：新分析结果追加到倒排表和磁盘日志（JSONL），同一封邮件重新分析时
+旧版本标记删除，启动时回放日志恢复索引。中文按字二元组切分，无需额外分词依赖。
+
+查询中的相对时间（“上周”）和明确的优先级（“高优先级”）作为过滤条件；“紧急”“重要”
+这类普通词照常参与检索，只给对应优先级的邮件加分，单独出现时才按优先级过滤。
+"""
+
+import heapq
+import json
+import logging
+import math
+import os
+import re
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from itertools import compress
+from operator import itemgetter
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .config import config
+
+logger = logging.getLogger(__name__)
+
+_CJK_CHARS = "\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff"
+_TOKEN = re.compile(f"[{_CJK_CHARS}]+|[a-z0-9]+(?:[._@-][a-z0-9]+)*")
+_CJK_RUN = re.compile(f"[{_CJK_CHARS}]")
+
+# 查询中不携带检索意义的词，检索前替换为分隔符
+_QUERY_STOP_PHRASES = [
+    "有哪些", "哪些", "是什么", "什么", "有没有", "相关的", "相关", "有关", "关于",
+    "帮我", "给我", "查找", "查询", "查看", "看看", "列出", "一下", "所有", "全部",
+    "邮件", "的", "了", "吗", "呢", "请",
+]
+
+# 明确指定优先级的词，作为过滤条件
+_PRIORITY_FILTERS = (
+    (("高优先级",), "high"),
+    (("中优先级", "普通优先级"), "medium"),
+    (("低优先级",), "low"),
+)
+# 暗示优先级的普通词，按顺序匹配（“不重要”需先于“重要”）
+_PRIORITY_HINTS = (
+    (("不重要", "不紧急"), "low"),
+    (("紧急", "重要"), "high"),
+)
+_PRIORITY_CODES = {"high": 1, "medium": 2, "low": 3}
+
+# 检索词的文档频率都不低于该值时才按 impact 顺序提前终止；
+# 倒排表在按 impact 排序后又追加的条目超过 _IMPACT_TAIL_LIMIT 时重新排序
+_IMPACT_MIN_DF = 2048
+_IMPACT_TAIL_LIMIT = 256
+
+# 旧版本日志中可能存在的占位结果（分析失败、内容过长）和模拟模式结果，回放时跳过
+_PLACEHOLDER_TAGS = {"分析失败", "内容过长"}
+_MOCK_TAGS = ["工作", "待回复"]
+_MOCK_KEY_POINTS = ["需要回复", "查看详情"]
+
+# 字段权重：主题和标签比摘要、要点更能代表邮件内容
+_FIELD_WEIGHTS = (("subject", 2.0), ("tags", 2.0), ("summary", 1.0), ("key_points", 1.0))
+
+_CN_NUMBERS = {"一": 1, "两": 2, "二": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9, "十": 10}
+_RECENT_DAYS = re.compile(r"(?:最近|近|过去)\s*(\d+|[一两二三四五六七八九十])\s*天")
+
+
+def tokenize(text: str) -> List[str]:
+    """切分文本：中文按字二元组，英文和数字按单词"""
+    tokens = []
+    for match in _TOKEN.finditer(text.lower()):
+        word = match.group()
+        if _CJK_RUN.match(word):
+            if len(word) == 1:
+                tokens.append(word)
+            else:
+                tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+        else:
+            tokens.append(word)
+    return tokens
+
+
+def parse_time_range(query: str, now: Optional[datetime] = None) -> Tuple[Optional[float], Optional[float], str]:
+    """识别查询中的相对时间（今天/昨天/本周/上周/本月/上个月/最近N天）
+
+    返回 (起始时间戳, 结束时间戳, 去掉时间表达后的查询)，未识别时时间为 None。
+    """
+    now = now or datetime.now()
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    week_start = today - timedelta(days=today.weekday())
+    month_start = today.replace(day=1)
+    last_month_start = (month_start - timedelta(days=1)).replace(day=1)
+
+    ranges = [
+        (("今天", "今日"), today, now),
+        (("昨天", "昨日"), today - timedelta(days=1), today),
+        (("上周", "上星期", "上个星期"), week_start - timedelta(days=7), week_start),
+        (("本周", "这周", "这个星期", "本星期"), week_start, now),
+        (("上个月", "上月"), last_month_start, month_start),
+        (("本月", "这个月"), month_start, now),
+    ]
+    for phrases, start, end in ranges:
+        for phrase in phrases:
+            if phrase in query:
+                return start.timestamp(), end.timestamp(), query.replace(phrase, " ")
+
+    match = _RECENT_DAYS.search(query)
+    if match:
+        value = match.group(1)
+        days = int(value) if value.isdigit() else _CN_NUMBERS[value]
+        start = today - timedelta(days=days - 1)
+        return start.timestamp(), now.timestamp(), query[:match.start()] + " " + query[match.end():]
+
+    return None, None, query
+
+
+def parse_priority(query: str) -> Tuple[Optional[str], bool, str]:
+    """识别查询中的优先级
+
+    返回 (high/medium/low 或 None, 是否为明确的优先级过滤, 去掉优先级词后的查询)。
+    """
+    for explicit, table in ((True, _PRIORITY_FILTERS), (False, _PRIORITY_HINTS)):
+        for phrases, priority in table:
+            for phrase in phrases:
+                if phrase in query:
+                    return priority, explicit, query.replace(phrase, " ")
+    return None, False, query
+
+
+def _query_terms(text: str) -> set:
+    for phrase in _QUERY_STOP_PHRASES:
+        text = text.replace(phrase, " ")
+    return set(tokenize(text))
+
+
+def parse_query(query: str, now: Optional[datetime] = None):
+    """解析查询，返回 (起始时间戳, 结束时间戳, 过滤优先级, 加分优先级, 检索词集合)
+
+    “紧急”“重要”这类词与其他检索词同时出现时保留为检索词并给对应优先级加分，
+    避免“重要客户的合同”把中、低优先级邮件全部过滤掉；单独出现时按优先级过滤。
+    """
+    start, end, text = parse_time_range(query, now)
+    priority, explicit, stripped = parse_priority(text)
+    if priority is None:
+        return start, end, None, None, _query_terms(text)
+    stripped_terms = _query_terms(stripped)
+    if explicit or not stripped_terms:
+        return start, end, priority, None, stripped_terms
+    return start, end, None, priority, _query_terms(text)
+
+
+def _is_placeholder(doc: dict) -> bool:
+    tags = doc.get("tags") or []
+    if _PLACEHOLDER_TAGS.intersection(tags):
+        return True
+    return tags == _MOCK_TAGS and doc.get("key_points") == _MOCK_KEY_POINTS
+
+
+def _to_timestamp(value) -> Optional[float]:
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, datetime):
+        return value.timestamp()
+    try:
+        return datetime.fromisoformat(str(value)).timestamp()
+    except ValueError:
+        return None
+
+
+class _OwnerIndex:
+    """单个用户的倒排表及文档数据，文档号在用户内部递增"""
+
+    def __init__(self):
+        # 倒排表按文档号递增追加，用紧凑数组保存文档号和 impact
+        self.postings: Dict[str, Tuple[array, array]] = {}
+        self.docs: List[dict] = []
+        self.doc_len: List[float] = []
+        # 没有收件时间的文档记为 -inf，不会落入任何时间范围
+        self.timestamps = array("d")
+        self.live: Dict[str, int] = {}
+        self.deleted = 0
+        self.total_len = 0.0
+        self.priority_counts = {"high": 0, "medium": 0, "low": 0}
+        # 各优先级的文档号（递增），含已删除的旧版本
+        self.priority_docs: Dict[str, array] = {p: array("l") for p in self.priority_counts}
+        # 按文档号索引的过滤掩码：alive 标记未删除，priority_masks 标记未删除且为该优先级，
+        # 检索时用 itertools.compress 在 C 层过滤倒排表
+        self.priority_codes = bytearray()
+        self.alive = bytearray()
+        self.priority_masks: Dict[int, bytearray] = {code: bytearray() for code in _PRIORITY_CODES.values()}
+        # 按需生成的按 impact 排序的倒排表下标，见 EmailSearchIndex._impact_order
+        self.impact_order: Dict[str, array] = {}
+
+    def append_doc(self, doc: dict) -> int:
+        doc_id = len(self.docs)
+        code = _PRIORITY_CODES.get(doc.get("priority"), 0)
+        received_at = doc.get("received_at")
+        self.docs.append(doc)
+        self.timestamps.append(received_at if received_at is not None else -math.inf)
+        self.priority_codes.append(code)
+        self.alive.append(1)
+        for mask_code, mask in self.priority_masks.items():
+            mask.append(1 if mask_code == code else 0)
+        if code:
+            self.priority_docs[doc["priority"]].append(doc_id)
+        return doc_id
+
+    def delete_doc(self, doc_id: int):
+        self.deleted += 1
+        self.alive[doc_id] = 0
+        code = self.priority_codes[doc_id]
+        if code:
+            self.priority_masks[code][doc_id] = 0
+
+
+class EmailSearchIndex:
+    """只追加的 BM25 倒排索引
+
+    倒排表中保存每个词在文档中的 BM25 词频分量（impact），长度归一化使用
+    写入时的平均文档长度，查询时只需乘以 idf，避免逐条重新计算。
+
+    每封邮件记录所属用户（user_id），倒排表按用户分开存放：查询只扫描该用户的
+    文档，idf 也按该用户的邮件计算；未指定用户的查询不返回任何结果。
+    """
+
+    k1 = 1.2
+    b = 0.75
+    # 查询中出现“紧急”“重要”等词时，对应优先级邮件的加分
+    priority_boost = 1.0
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._owners: Dict[str, _OwnerIndex] = {}
+        self._log = None
+
+    def __len__(self) -> int:
+        return sum(len(owner.live) for owner in self._owners.values())
+
+    def load(self):
+        """回放磁盘日志重建索引，同一用户的同一封邮件只保留最后一个版本"""
+        if not self.path or not os.path.exists(self.path):
+            return
+        latest: Dict[Tuple[str, str], dict] = {}
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    doc = json.loads(line)
+                except json.JSONDecodeError:
+                    # 进程中断可能留下不完整的最后一行
+                    continue
+                # 没有所属用户的旧日志无法归属，跳过
+                if not doc.get("user_id") or _is_placeholder(doc):
+                    continue
+                key = (doc["user_id"], doc["email_id"])
+                latest.pop(key, None)
+                latest[key] = doc
+
+        # 先统计各用户全部文档再建索引，使 impact 使用该用户语料的平均长度
+        by_owner: Dict[str, List[dict]] = {}
+        for doc in latest.values():
+            by_owner.setdefault(doc["user_id"], []).append(doc)
+        for user_id, docs in by_owner.items():
+            owner = self._owners.setdefault(user_id, _OwnerIndex())
+            term_weights = [self._term_weights(doc) for doc in docs]
+            lengths = [sum(weights.values()) for weights in term_weights]
+            avgdl = sum(lengths) / len(lengths)
+            for doc, weights in zip(docs, term_weights):
+                self._index(owner, doc, weights, avgdl)
+        logger.info(f"全文索引加载完成: {len(self)} 封邮件, {len(self._owners)} 个用户")
+
+    def add(self, user_id: str, email_id: str, subject: str, summary: str, tags: List[str],
+            key_points: List[str], priority: str, received_at=None):
+        """索引一封已分析的邮件，并追加写入磁盘日志；received_at 未知时不参与时间过滤"""
+        if not user_id:
+            raise ValueError("索引邮件需要指定 user_id")
+        doc = {
+            "user_id": user_id,
+            "email_id": email_id,
+            "subject": subject,
+            "summary": summary,
+            "tags": list(tags),
+            "key_points": list(key_points),
+            "priority": priority,
+            "received_at": _to_timestamp(received_at),
+        }
+        owner = self._owners.setdefault(user_id, _OwnerIndex())
+        self._index(owner, doc, self._term_weights(doc))
+        self._append_log(doc)
+
+    @staticmethod
+    def _term_weights(doc: dict) -> Dict[str, float]:
+        """按字段权重累计词频"""
+        weights: Dict[str, float] = {}
+        for field, weight in _FIELD_WEIGHTS:
+            value = doc.get(field)
+            if isinstance(value, list):
+                value = " ".join(value)
+            for token in tokenize(value or ""):
+                weights[token] = weights.get(token, 0.0) + weight
+        return weights
+
+    def _index(self, owner: _OwnerIndex, doc: dict, weights: Dict[str, float], avgdl: Optional[float] = None):
+        previous = owner.live.get(doc["email_id"])
+        if previous is not None:
+            owner.delete_doc(previous)
+            owner.total_len -= owner.doc_len[previous]
+            self._count_priority(owner, owner.docs[previous].get("priority"), -1)
+
+        doc_id = owner.append_doc(doc)
+        length = sum(weights.values())
+        owner.doc_len.append(length)
+        owner.live[doc["email_id"]] = doc_id
+        owner.total_len += length
+        self._count_priority(owner, doc.get("priority"), 1)
+
+        if avgdl is None:
+            avgdl = owner.total_len / len(owner.live)
+        norm = self.k1 * (1 - self.b + self.b * length / avgdl) if avgdl else self.k1
+        for token, tf in weights.items():
+            postings = owner.postings.get(token)
+            if postings is None:
+                postings = owner.postings[token] = (array("l"), array("f"))
+            postings[0].append(doc_id)
+            postings[1].append(tf * (self.k1 + 1) / (tf + norm))
+
+    @staticmethod
+    def _count_priority(owner: _OwnerIndex, priority: Optional[str], delta: int):
+        if priority in owner.priority_counts:
+            owner.priority_counts[priority] += delta
+
+    def _append_log(self, doc: dict):
+        if not self.path:
+            return
+        if self._log is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._log = open(self.path, "a", encoding="utf-8")
+        self._log.write(json.dumps(doc, ensure_ascii=False) + "\n")
+        self._log.flush()
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def search(self, query: str, user_id: Optional[str], k: int = 10,
+               now: Optional[datetime] = None) -> List[dict]:
+        """在 user_id 的邮件中检索与查询最相关的 k 封，支持查询中的相对时间和优先级条件"""
+        owner = self._owners.get(user_id) if user_id else None
+        if owner is None or k <= 0:
+            return []
+        start, end, priority, boost_priority, terms = parse_query(query, now)
+        timestamps = owner.timestamps
+        timed = start is not None
+        # 未删除（且为过滤优先级）的文档掩码；没有删除也没有优先级过滤时无需检查
+        mask = owner.priority_masks[_PRIORITY_CODES[priority]] if priority else owner.alive
+        masked = priority is not None or owner.deleted > 0
+
+        if not terms:
+            if not timed and priority is None:
+                return []
+            # 只有时间或优先级条件时按时间倒序返回
+            doc_ids = owner.priority_docs[priority] if priority else range(len(owner.docs))
+            top = self._latest(owner, doc_ids, k, mask, start, end)
+            return [self._result(owner, d, 0.0) for d in top]
+
+        n = len(owner.live)
+        if n == 0:
+            return []
+
+        def contributions(ids: array, impacts: array, idf: float):
+            """倒排表中通过过滤的 (文档号, 得分)，删除和优先级在 C 层过滤，时间范围逐条判断"""
+            pairs = zip(ids, map(idf.__mul__, impacts))
+            if masked:
+                pairs = compress(pairs, map(mask.__getitem__, ids))
+            if timed:
+                pairs = ((d, s) for d, s in pairs if start <= timestamps[d] < end)
+            return pairs
+
+        boost_code = _PRIORITY_CODES[boost_priority] if boost_priority else 0
+        present = [t for t in terms if t in owner.postings]
+        if not present:
+            return []
+
+        def accept(doc_id: int) -> bool:
+            return (not masked or mask[doc_id]) and (not timed or start <= timestamps[doc_id] < end)
+
+        # 含低频词时逐条扫描配合剪枝已经很快；全是高频词时改为按 impact 提前终止，
+        # 过滤掉的文档过多导致提前终止不划算时退回逐条扫描
+        if min(len(owner.postings[t][0]) for t in present) >= _IMPACT_MIN_DF:
+            top = self._search_by_impact(owner, present, n, k, accept, boost_code)
+            if top is not None:
+                return [self._result(owner, doc_id, score) for doc_id, score in top]
+
+        # 按文档频率从低到高处理，高频词的 idf 低、得分上界也低
+        term_postings = sorted((owner.postings[t] for t in present), key=lambda p: len(p[0]))
+        scores: Dict[int, float] = {}
+        skipped = []
+
+        for ids, impacts in term_postings:
+            df = len(ids)
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+            # 已有足够候选且扫描倒排表代价更高时，只为候选文档补分（MaxScore 剪枝）
+            if len(scores) >= k and df > 2 * len(scores):
+                for doc_id in scores:
+                    pos = bisect_left(ids, doc_id)
+                    if pos < df and ids[pos] == doc_id:
+                        scores[doc_id] += idf * impacts[pos]
+                skipped.append((ids, impacts, idf))
+                continue
+
+            if not scores:
+                scores = dict(contributions(ids, impacts, idf))
+                continue
+            get = scores.get
+            for doc_id, score in contributions(ids, impacts, idf):
+                scores[doc_id] = get(doc_id, 0.0) + score
+
+        top = self._top(owner, scores, k, boost_code)
+
+        # 只含被剪枝词的文档得分不超过这些词的上界之和（加上优先级加分）；
+        # 第 k 名低于上界时补做完整扫描，保证结果精确
+        upper_bound = sum(idf * (self.k1 + 1) for _, _, idf in skipped)
+        if boost_code:
+            upper_bound += self.priority_boost
+        if skipped and len(top) == k and top[-1][1] < upper_bound:
+            extra: Dict[int, float] = {}
+            for ids, impacts, idf in skipped:
+                get = extra.get
+                for doc_id, score in contributions(ids, impacts, idf):
+                    if doc_id not in scores:
+                        extra[doc_id] = get(doc_id, 0.0) + score
+            extra.update(scores)
+            top = self._top(owner, extra, k, boost_code)
+
+        return [self._result(owner, doc_id, score) for doc_id, score in top]
+
+    def _impact_order(self, owner: _OwnerIndex, term: str) -> array:
+        """倒排表中前一部分条目按 impact 从高到低的下标；之后追加的条目（尾部）不在其中，
+        尾部超过 _IMPACT_TAIL_LIMIT 时重新排序"""
+        ids, impacts = owner.postings[term]
+        order = owner.impact_order.get(term)
+        if order is None or len(ids) - len(order) > _IMPACT_TAIL_LIMIT:
+            order = array("l", sorted(range(len(ids)), key=impacts.__getitem__, reverse=True))
+            owner.impact_order[term] = order
+        return order
+
+    def _search_by_impact(self, owner: _OwnerIndex, terms: List[str], n: int, k: int,
+                          accept: Callable[[int], bool], boost_code: int) -> Optional[List[Tuple[int, float]]]:
+        """按 impact 从高到低读取各词的倒排表，逐个文档计算完整得分（阈值算法）
+
+        未读到的文档在每个词上的 impact 都不超过当前读取位置，得分上界为各词当前位置的
+        得分之和；第 k 名不低于该上界即可停止，通常只需读取倒排表的很小一部分。
+        读取的文档数超过逐条扫描代价的一定比例时（多为过滤条件很严格）返回 None。
+        """
+        lists = []
+        total = 0
+        for term in terms:
+            ids, impacts = owner.postings[term]
+            df = len(ids)
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            lists.append((ids, impacts, idf, self._impact_order(owner, term)))
+            total += df
+        budget = max(4 * k, total // (2 * len(lists) ** 2))
+        boost = self.priority_boost if boost_code else 0.0
+        codes = owner.priority_codes
+        heap: List[Tuple[float, int]] = []
+        seen = set()
+
+        def consider(doc_id: int):
+            if doc_id in seen:
+                return
+            seen.add(doc_id)
+            if not accept(doc_id):
+                return
+            score = boost if boost and codes[doc_id] == boost_code else 0.0
+            for ids, impacts, idf, _ in lists:
+                pos = bisect_left(ids, doc_id)
+                if pos < len(ids) and ids[pos] == doc_id:
+                    score += idf * impacts[pos]
+            if len(heap) < k:
+                heapq.heappush(heap, (score, doc_id))
+            elif score > heap[0][0]:
+                heapq.heapreplace(heap, (score, doc_id))
+
+        # 尚未排序的尾部条目逐个计算
+        for ids, _, _, order in lists:
+            for pos in range(len(order), len(ids)):
+                consider(ids[pos])
+
+        # 每次推进当前位置得分最高的倒排表，得分上界下降最快
+        cursors = [0] * len(lists)
+        current = [idf * impacts[order[0]] if order else 0.0 for _, impacts, idf, order in lists]
+        while not (len(heap) == k and heap[0][0] >= boost + sum(current)):
+            i = max(range(len(lists)), key=current.__getitem__)
+            ids, impacts, idf, order = lists[i]
+            depth = cursors[i]
+            if depth >= len(order):
+                break
+            consider(ids[order[depth]])
+            depth += 1
+            cursors[i] = depth
+            current[i] = idf * impacts[order[depth]] if depth < len(order) else 0.0
+            if len(seen) > budget:
+                return None
+
+        return [(doc_id, score) for score, doc_id in sorted(heap, reverse=True)]
+
+    def _top(self, owner: _OwnerIndex, scores: Dict[int, float], k: int, boost_code: int) -> List[Tuple[int, float]]:
+        """取得分前 k 的文档；boost_code 指定的优先级加 priority_boost 分
+
+        加分后的第 k 名不低于加分前的第 k 名，因此只需为原始得分不低于
+        (第 k 名 - 加分) 的文档计算加分。
+        """
+        top = heapq.nlargest(k, scores.items(), key=itemgetter(1))
+        if not boost_code or not top:
+            return top
+        cut = top[-1][1] - self.priority_boost if len(top) == k else -math.inf
+        codes = owner.priority_codes
+        boost = self.priority_boost
+        boosted = [(d, s + boost if codes[d] == boost_code else s) for d, s in scores.items() if s >= cut]
+        return heapq.nlargest(k, boosted, key=itemgetter(1))
+
+    @staticmethod
+    def _latest(owner: _OwnerIndex, doc_ids, k: int, mask: bytearray,
+                start: Optional[float], end: Optional[float]) -> List[int]:
+        """按时间倒序取前 k 个未删除（且满足优先级）并落在时间范围内的文档
+
+        先不过滤取时间最新的一小批再筛选，多数情况下即可凑满 k 个；凑不满时再完整过滤一遍。
+        """
+        timestamps = owner.timestamps
+
+        def keep(doc_id: int) -> bool:
+            return mask[doc_id] and (start is None or start <= timestamps[doc_id] < end)
+
+        key = timestamps.__getitem__
+        top = heapq.nlargest(4 * k, doc_ids, key=key)
+        result = [d for d in top if keep(d)]
+        if len(result) >= k or len(top) < 4 * k:
+            return result[:k]
+        return heapq.nlargest(k, filter(keep, doc_ids), key=key)
+
+    @staticmethod
+    def _result(owner: _OwnerIndex, doc_id: int, score: float) -> dict:
+        doc = owner.docs[doc_id]
+        received_at = doc.get("received_at")
+        return {
+            "email_id": doc["email_id"],
+            "subject": doc["subject"],
+            "summary": doc["summary"],
+            "priority": doc["priority"],
+            "tags": doc["tags"],
+            "key_points": doc["key_points"],
+            "received_at": datetime.fromtimestamp(received_at).isoformat() if received_at is not None else None,
+            "score": round(score, 4),
+        }
+
+    def stats(self, user_id: Optional[str]) -> dict:
+        """某个用户的索引统计，供聊天和检索接口使用"""
+        owner = self._owners.get(user_id) if user_id else None
+        if owner is None:
+            owner = _OwnerIndex()
+        return {
+            "indexed_emails": len(owner.live),
+            "terms": len(owner.postings),
+            "priority_distribution": dict(owner.priority_counts),
+        }
+
+
+# 全局索引
+search_index = EmailSearchIndex(config.SEARCH_INDEX_PATH or None)
@@ -0,0 +1,271 @@
+# 本地 token 计数与请求规划
+"""
+在调用 OpenAI 之前本地估算 token 数：超长输入按策略裁剪或拒绝，
+按输入大小选择模型档位和 max_tokens，并累计每个请求的 token 用量。
+
+优先使用 tiktoken 精确计数；未安装或编码文件不可用时退回到按中日韩字符
+单独计数的估算，保证中文邮件不会被严重低估。
+
+tiktoken 首次使用需联网下载编码文件，因此在服务启动时于线程池中预加载，
+请求路径不会触发下载；加载完成前按估算计数。离线部署可预先下载编码文件
+并通过 TIKTOKEN_CACHE_DIR 环境变量指定缓存目录。
+"""
+
+import logging
+import math
+import re
+from typing import Callable, Dict, Iterable, List, Optional
+
+from .config import config
+
+logger = logging.getLogger(__name__)
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - 可选依赖
+    tiktoken = None
+
+# 常用模型的上下文窗口，未列出的模型按最保守的 4k 处理
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16385,
+    "gpt-3.5-turbo-1106": 16385,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-1106-preview": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+}
+DEFAULT_CONTEXT_WINDOW = 4096
+
+# 每条消息的格式开销及回复引导开销（参照 OpenAI cookbook 的计数方式）
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+# 中日韩文字及全角标点
+_CJK_CHAR = re.compile(
+    "[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff"
+    "\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]"
+)
+
+
+class InputTooLargeError(ValueError):
+    """输入超出可处理的 token 上限"""
+
+    def __init__(self, tokens: int, limit: int):
+        super().__init__(f"输入过长: {tokens} tokens，上限 {limit} tokens")
+        self.tokens = tokens
+        self.limit = limit
+
+
+class TokenPlan:
+    """单次调用的规划结果
+
+    estimated_prompt_tokens 为调用前的本地计数，prompt_tokens 在拿到接口返回的
+    实际用量后更新，两者对比可看出本地计数的偏差。
+    """
+
+    def __init__(self, task: str, model: str, prompt_tokens: int, max_tokens: int,
+                 input_tokens: int, truncated: bool = False):
+        self.task = task
+        self.model = model
+        self.estimated_prompt_tokens = prompt_tokens
+        self.prompt_tokens = prompt_tokens
+        self.max_tokens = max_tokens
+        self.input_tokens = input_tokens
+        self.truncated = truncated
+        self.completion_tokens: Optional[int] = None
+
+    def to_dict(self) -> dict:
+        return {
+            "model": self.model,
+            "estimated_prompt_tokens": self.estimated_prompt_tokens,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "max_tokens": self.max_tokens,
+            "input_tokens": self.input_tokens,
+            "truncated": self.truncated,
+        }
+
+
+# 已预加载的编码，按模型名索引
+_encodings: Dict[str, object] = {}
+
+
+def preload_encodings(models: Iterable[str]):
+    """加载各模型的编码（可能联网下载，需在线程池中调用），失败的模型使用估算"""
+    if tiktoken is None:
+        logger.warning("未安装 tiktoken，使用估算计数")
+        return
+    failed = []
+    for model in models:
+        if not model or model in _encodings:
+            continue
+        try:
+            try:
+                _encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                _encodings[model] = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            failed.append(f"{model}: {str(e)}")
+    if failed:
+        logger.warning(f"tiktoken 编码加载失败，使用估算计数: {'; '.join(failed)}")
+
+
+def _get_encoding(model: str):
+    """获取已预加载的编码，未加载时返回 None 使用估算"""
+    return _encodings.get(model)
+
+
+def _estimate_tokens(text: str) -> int:
+    """估算 token 数：中日韩字符约 1.5 token/字，其余约 4 字符/token"""
+    cjk = len(_CJK_CHAR.findall(text))
+    other = len(text) - cjk
+    return math.ceil(cjk * 1.5 + other / 4)
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    """计算文本的 token 数"""
+    if not text:
+        return 0
+    encoding = _get_encoding(model or config.OPENAI_MODEL)
+    if encoding is None:
+        return _estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages: List[Dict[str, str]], model: Optional[str] = None) -> int:
+    """计算 ChatCompletion 消息列表的 prompt token 数"""
+    total = TOKENS_PER_REPLY
+    for message in messages:
+        total += TOKENS_PER_MESSAGE
+        for value in message.values():
+            total += count_tokens(value, model)
+    return total
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: Optional[str] = None) -> str:
+    """将文本裁剪到不超过 max_tokens 个 token"""
+    if max_tokens <= 0:
+        return ""
+    encoding = _get_encoding(model or config.OPENAI_MODEL)
+    if encoding is not None:
+        tokens = encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        # 截断处可能切开多字节字符，去掉解码出的替换字符
+        return encoding.decode(tokens[:max_tokens]).rstrip("\ufffd")
+
+    if _estimate_tokens(text) <= max_tokens:
+        return text
+    # 估算计数单调递增，二分查找最长前缀
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if _estimate_tokens(text[:mid]) <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low]
+
+
+def get_context_window(model: str) -> int:
+    """获取模型上下文窗口大小"""
+    return MODEL_CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW)
+
+
+def select_model(input_tokens: int) -> str:
+    """小邮件路由到快速档模型，其余使用默认模型"""
+    if config.OPENAI_FAST_MODEL and input_tokens <= config.FAST_MODEL_TOKEN_THRESHOLD:
+        return config.OPENAI_FAST_MODEL
+    return config.OPENAI_MODEL
+
+
+def plan_request(task: str, build_messages: Callable[[str], List[Dict[str, str]]],
+                 body: str, max_output_tokens: int):
+    """规划一次调用：选择模型、按策略裁剪或拒绝超长正文、确定 max_tokens
+
+    build_messages 以（可能被裁剪的）正文生成消息列表，正文之外的部分视为固定开销。
+    返回 (messages, TokenPlan)。
+    """
+    input_tokens = count_tokens(body)
+    model = select_model(input_tokens)
+    window = get_context_window(model)
+
+    messages = build_messages(body)
+    prompt_tokens = count_message_tokens(messages, model)
+    overhead = prompt_tokens - count_tokens(body, model)
+
+    # 正文预算：不超过配置上限，且为回复保留 max_output_tokens
+    budget = min(config.MAX_INPUT_TOKENS, window - overhead - max_output_tokens)
+    if budget <= 0:
+        raise InputTooLargeError(prompt_tokens, window - max_output_tokens)
+
+    truncated = False
+    if input_tokens > budget:
+        if config.OVERSIZE_POLICY == "reject":
+            raise InputTooLargeError(input_tokens, budget)
+        body = truncate_to_tokens(body, budget, model)
+        messages = build_messages(body)
+        prompt_tokens = count_message_tokens(messages, model)
+        truncated = True
+
+    max_tokens = max(1, min(max_output_tokens, window - prompt_tokens))
+    plan = TokenPlan(task, model, prompt_tokens, max_tokens, input_tokens, truncated)
+    return messages, plan
+
+
+class TokenUsageTracker:
+    """按任务和模型累计 token 用量"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.rejected = 0
+        self.truncated = 0
+        self.by_model: Dict[str, Dict[str, int]] = {}
+        self.by_task: Dict[str, Dict[str, int]] = {}
+
+    def record(self, plan: TokenPlan, usage: Optional[dict] = None):
+        """记录一次调用，usage 为接口返回的实际用量"""
+        if usage:
+            plan.prompt_tokens = usage.get("prompt_tokens", plan.prompt_tokens)
+            plan.completion_tokens = usage.get("completion_tokens")
+
+        self.requests += 1
+        if plan.truncated:
+            self.truncated += 1
+        for key, bucket in ((plan.model, self.by_model), (plan.task, self.by_task)):
+            entry = bucket.setdefault(key, {
+                "requests": 0, "estimated_prompt_tokens": 0, "prompt_tokens": 0, "completion_tokens": 0
+            })
+            entry["requests"] += 1
+            entry["estimated_prompt_tokens"] += plan.estimated_prompt_tokens
+            entry["prompt_tokens"] += plan.prompt_tokens
+            entry["completion_tokens"] += plan.completion_tokens or 0
+
+        logger.info(
+            f"token用量 [{plan.task}] 模型: {plan.model}, prompt: {plan.prompt_tokens} (预估 {plan.estimated_prompt_tokens}), "
+            f"completion: {plan.completion_tokens}, max_tokens: {plan.max_tokens}, 裁剪: {plan.truncated}"
+        )
+
+    def record_rejected(self, task: str, error: InputTooLargeError):
+        self.rejected += 1
+        logger.warning(f"token预检拒绝 [{task}]: {str(error)}")
+
+    def to_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "rejected": self.rejected,
+            "truncated": self.truncated,
+            "by_model": self.by_model,
+            "by_task": self.by_task,
+            "tokenizer": "tiktoken" if _get_encoding(config.OPENAI_MODEL) is not None else "estimate",
+        }
+
+
+# 全局用量统计
+usage_tracker = TokenUsageTracker()
@@ -0,0 +1,265 @@
+# 请求分阶段计时与按需性能剖析
+"""
+为每个请求记录分阶段耗时：请求校验、提示词构建、线程池排队、上游调用、
+JSON解析和响应编码。最慢的 N 个请求连同阶段明细保存在内存中，供调试接口查看。
+
+cProfile 剖析默认关闭，可在运行时通过调试接口按比例对请求抽样开启。
+"""
+
+import asyncio
+import cProfile
+import functools
+import heapq
+import io
+import itertools
+import logging
+import pstats
+import random
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional
+
+from fastapi.routing import APIRoute
+
+from .config import config
+
+logger = logging.getLogger(__name__)
+
+_current_trace: ContextVar[Optional["RequestTrace"]] = ContextVar("current_trace", default=None)
+
+
+class RequestTrace:
+    """单个请求的阶段耗时记录"""
+
+    def __init__(self, method: str, path: str):
+        self.request_id = uuid.uuid4().hex[:12]
+        self.method = method
+        self.path = path
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.handler_start: Optional[float] = None
+        self.handler_end: Optional[float] = None
+        self.response_start: Optional[float] = None
+        self.end: Optional[float] = None
+        self.status_code: Optional[int] = None
+        self.stages: Dict[str, float] = {}
+        self.stage_counts: Dict[str, int] = {}
+        self.profile: Optional[str] = None
+
+    def add(self, stage: str, seconds: float):
+        """累计某阶段耗时，同一请求内可多次出现（如批量分析）"""
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        self.stage_counts[stage] = self.stage_counts.get(stage, 0) + 1
+
+    @property
+    def total_ms(self) -> float:
+        end = self.end if self.end is not None else time.perf_counter()
+        return (end - self.start) * 1000
+
+    def breakdown(self) -> Dict[str, float]:
+        """阶段明细（毫秒），handler_other 为处理函数中未被细分阶段覆盖的部分"""
+        result: Dict[str, float] = {}
+        if self.handler_start is not None:
+            result["request_validation"] = self.handler_start - self.start
+        result.update(self.stages)
+        if self.handler_start is not None and self.handler_end is not None:
+            handler = self.handler_end - self.handler_start
+            result["handler_other"] = max(0.0, handler - sum(self.stages.values()))
+            if self.response_start is not None:
+                result["response_encoding"] = max(0.0, self.response_start - self.handler_end)
+        return {stage: round(seconds * 1000, 3) for stage, seconds in result.items()}
+
+    def to_dict(self) -> dict:
+        data = {
+            "request_id": self.request_id,
+            "method": self.method,
+            "path": self.path,
+            "status_code": self.status_code,
+            "started_at": self.started_at,
+            "total_ms": round(self.total_ms, 3),
+            "stages_ms": self.breakdown(),
+            "stage_counts": self.stage_counts,
+        }
+        if self.profile is not None:
+            data["profile"] = self.profile
+        return data
+
+
+def current_trace() -> Optional[RequestTrace]:
+    """当前请求的追踪记录，不在请求上下文中时返回 None"""
+    return _current_trace.get()
+
+
+@contextmanager
+def span(stage: str):
+    """记录一段代码的耗时到当前请求"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(stage, time.perf_counter() - start)
+
+
+async def run_in_executor_traced(stage: str, func: Callable, *args) -> Any:
+    """在默认线程池中执行，分别记录排队时间（executor_queue）和执行时间"""
+    trace = _current_trace.get()
+    submitted = time.perf_counter()
+
+    def timed():
+        started = time.perf_counter()
+        result = func(*args)
+        return started, time.perf_counter(), result
+
+    started, finished, result = await asyncio.get_event_loop().run_in_executor(None, timed)
+    if trace is not None:
+        trace.add("executor_queue", started - submitted)
+        trace.add(stage, finished - started)
+    return result
+
+
+class RequestTracer:
+    """保存最慢请求和剖析结果，并管理运行时抽样剖析开关"""
+
+    def __init__(self, slow_capacity: int, profile_capacity: int):
+        self.slow_capacity = slow_capacity
+        self.profile_sample_rate = 0.0
+        self.profile_top_n = 30
+        self.total_requests = 0
+        self._slowest: List[tuple] = []
+        self._seq = itertools.count()
+        self._profiles: deque = deque(maxlen=profile_capacity)
+        self._profiling_active = False
+
+    def set_profiling(self, sample_rate: float, top_n: Optional[int] = None):
+        """设置剖析抽样比例（0-1，由接口模型校验），0 为关闭"""
+        self.profile_sample_rate = sample_rate
+        if top_n is not None:
+            self.profile_top_n = top_n
+        logger.info(f"请求剖析抽样比例: {self.profile_sample_rate}")
+
+    def should_profile(self) -> bool:
+        # cProfile 在同一线程只能有一个有效的剖析器，已有请求在剖析时跳过
+        if self.profile_sample_rate <= 0 or self._profiling_active:
+            return False
+        return random.random() < self.profile_sample_rate
+
+    def record(self, trace: RequestTrace):
+        """请求结束时调用，维护最慢的 N 个请求"""
+        self.total_requests += 1
+        entry = (trace.total_ms, next(self._seq), trace)
+        if len(self._slowest) < self.slow_capacity:
+            heapq.heappush(self._slowest, entry)
+        elif entry[0] > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, entry)
+        if trace.profile is not None:
+            self._profiles.append(trace)
+
+    def slowest(self) -> List[dict]:
+        return [trace.to_dict() for _, _, trace in sorted(self._slowest, key=lambda e: e[0], reverse=True)]
+
+    def profiles(self) -> List[dict]:
+        return [trace.to_dict() for trace in reversed(self._profiles)]
+
+    def reset(self):
+        self._slowest = []
+        self._profiles.clear()
+        self.total_requests = 0
+
+    def settings(self) -> dict:
+        return {
+            "slow_capacity": self.slow_capacity,
+            "profile_sample_rate": self.profile_sample_rate,
+            "profile_top_n": self.profile_top_n,
+            "total_requests": self.total_requests,
+        }
+
+    def start_profile(self) -> Optional[cProfile.Profile]:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # 进程内已有其他剖析工具在运行
+            return None
+        self._profiling_active = True
+        return profiler
+
+    def stop_profile(self, profiler: cProfile.Profile, trace: RequestTrace):
+        profiler.disable()
+        self._profiling_active = False
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(self.profile_top_n)
+        trace.profile = output.getvalue()
+
+
+# 全局追踪器
+tracer = RequestTracer(config.TRACE_SLOW_REQUESTS, config.TRACE_PROFILE_HISTORY)
+
+
+class TracingMiddleware:
+    """ASGI 中间件：为每个 HTTP 请求创建追踪记录并按需剖析
+
+    剖析器挂在事件循环线程上，期间同一线程上并发执行的其他请求也会计入结果，
+    线程池中的上游调用不在剖析范围内（其耗时见阶段明细）。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace = RequestTrace(scope.get("method", ""), scope.get("path", ""))
+        token = _current_trace.set(trace)
+        profiler = tracer.start_profile() if tracer.should_profile() else None
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                trace.response_start = time.perf_counter()
+                trace.status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            trace.end = time.perf_counter()
+            if profiler is not None:
+                tracer.stop_profile(profiler, trace)
+            _current_trace.reset(token)
+            tracer.record(trace)
+            if trace.total_ms >= config.SLOW_REQUEST_MS:
+                logger.warning(f"慢请求 {trace.method} {trace.path}: {trace.total_ms:.1f}ms, 阶段: {trace.breakdown()}")
+
+
+def traced_endpoint(func: Callable) -> Callable:
+    """包装路由处理函数，标记处理函数的开始和结束以区分校验和编码阶段"""
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.handler_start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            if trace is not None:
+                trace.handler_end = time.perf_counter()
+
+    return wrapper
+
+
+class TracedRoute(APIRoute):
+    """自动为所有处理函数加上 traced_endpoint 的路由类"""
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        if asyncio.iscoroutinefunction(endpoint):
+            endpoint = traced_endpoint(endpoint)
+        super().__init__(path, endpoint, **kwargs)
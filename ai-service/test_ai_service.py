@@ -12,6 +12,8 @@ from datetime import datetime
 
 # AI服务地址
 AI_SERVICE_URL = "http://localhost:8001"
+# 全文索引按用户隔离，检索相关测试使用同一个测试用户
+TEST_USER_ID = "test-user"
 
 async def test_health_check():
     """测试健康检查"""
@@ -48,7 +50,8 @@ async def test_email_analysis():
         "email_id": "test-001",
         "subject": "紧急：项目进度汇报",
         "content": "您好，需要您在今天下午5点前提交项目进度报告。这个报告对我们的季度评估很重要，请务必按时完成。如有问题请及时联系我。谢谢！",
-        "sender": "manager@company.com"
+        "sender": "manager@company.com",
+        "user_id": TEST_USER_ID
     }
     
     async with aiohttp.ClientSession() as session:
@@ -77,9 +80,9 @@ async def test_ai_chat():
     print("🔍 测试AI聊天...")
     
     test_messages = [
-        {"message": "我有25封未读邮件，有什么建议吗？"},
-        {"message": "帮我分析一下邮件的优先级"},
-        {"message": "如何快速处理大量邮件？"}
+        {"message": "我有25封未读邮件，有什么建议吗？", "user_id": TEST_USER_ID},
+        {"message": "帮我分析一下邮件的优先级", "user_id": TEST_USER_ID},
+        {"message": "如何快速处理大量邮件？", "user_id": TEST_USER_ID}
     ]
     
     async with aiohttp.ClientSession() as session:
@@ -169,6 +172,56 @@ async def test_email_classification():
                     return False
     return True
 
+async def test_raw_ingest():
+    """测试原始邮件导入功能"""
+    print("🔍 测试原始邮件导入...")
+    
+    raw_mbox = (
+        "From manager@company.com Mon Jan  1 09:00:00 2024\n"
+        "From: manager@company.com\n"
+        "Subject: =?gb2312?B?vfS8saO6z+7Ev734tsi4/NDC?=\n"
+        "Message-ID: <raw-001@company.com>\n"
+        "Content-Type: text/plain; charset=gb2312\n"
+        "Content-Transfer-Encoding: base64\n"
+        "\n"
+        "x+vU2r3xzOzPws7nzuW148ewzOG9u8/uxL+9+LbIsai45qGj\n"
+        "\n"
+    ).encode()
+    
+    async with aiohttp.ClientSession() as session:
+        async with session.post(
+            f"{AI_SERVICE_URL}/ingest/raw?include_results=true&user_id={TEST_USER_ID}",
+            data=raw_mbox,
+            headers={'Content-Type': 'application/mbox'}
+        ) as response:
+            if response.status == 200:
+                data = await response.json()
+                print(f"✅ 原始邮件导入成功:")
+                print(f"   导入统计: {data.get('ingest_stats')}")
+                print(f"   分析结果: {[r.get('email_id') for r in data.get('results', [])]}")
+                return True
+            else:
+                error = await response.text()
+                print(f"❌ 原始邮件导入失败: {response.status}, {error}")
+                return False
+
+async def test_search():
+    """测试全文检索功能"""
+    print("🔍 测试全文检索...")
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{AI_SERVICE_URL}/search", params={"q": "项目进度", "k": 5, "user_id": TEST_USER_ID}) as response:
+            if response.status == 200:
+                data = await response.json()
+                print(f"✅ 全文检索成功:")
+                print(f"   已索引邮件: {data.get('indexed_emails')}")
+                print(f"   命中: {[r.get('subject') for r in data.get('results', [])]}")
+                print(f"   耗时: {data.get('took_ms')}ms")
+                return True
+            else:
+                error = await response.text()
+                print(f"❌ 全文检索失败: {response.status}, {error}")
+                return False
+
 async def test_stats():
     """测试统计信息"""
     print("🔍 测试统计信息...")
@@ -186,6 +239,44 @@ async def test_stats():
                 print(f"❌ 统计信息获取失败: {response.status}, {error}")
                 return False
 
+async def test_token_stats():
+    """测试 token 用量统计"""
+    print("🔍 测试 token 用量统计...")
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{AI_SERVICE_URL}/stats/tokens") as response:
+            if response.status == 200:
+                data = await response.json()
+                print(f"✅ token 统计获取成功:")
+                print(f"   请求数: {data.get('requests')}")
+                print(f"   裁剪/拒绝: {data.get('truncated')}/{data.get('rejected')}")
+                print(f"   计数方式: {data.get('tokenizer')}")
+                return True
+            else:
+                error = await response.text()
+                print(f"❌ token 统计获取失败: {response.status}, {error}")
+                return False
+
+async def test_slow_requests():
+    """测试慢请求追踪调试接口"""
+    print("🔍 测试慢请求追踪...")
+    async with aiohttp.ClientSession() as session:
+        # 调试接口需携带 DEBUG_TOKEN，或服务端开启 DEBUG_ENDPOINTS_ENABLED
+        headers = {'X-Debug-Token': os.getenv('DEBUG_TOKEN')} if os.getenv('DEBUG_TOKEN') else {}
+        async with session.get(f"{AI_SERVICE_URL}/debug/slow-requests", headers=headers) as response:
+            if response.status == 200:
+                data = await response.json()
+                requests = data.get('requests', [])
+                print(f"✅ 慢请求记录获取成功:")
+                print(f"   已记录请求: {data.get('settings', {}).get('total_requests')}")
+                if requests:
+                    print(f"   最慢请求: {requests[0].get('path')} {requests[0].get('total_ms')}ms")
+                    print(f"   阶段明细: {requests[0].get('stages_ms')}")
+                return True
+            else:
+                error = await response.text()
+                print(f"❌ 慢请求记录获取失败: {response.status}, {error}")
+                return False
+
 async def main():
     """主测试函数"""
     print("🚀 开始AI服务功能测试")
@@ -209,7 +300,11 @@ async def main():
         ("AI聊天", test_ai_chat),
         ("回复生成", test_reply_generation),
         ("邮件分类", test_email_classification),
+        ("原始邮件导入", test_raw_ingest),
+        ("全文检索", test_search),
         ("统计信息", test_stats),
+        ("token统计", test_token_stats),
+        ("慢请求追踪", test_slow_requests),
     ]
     
     results = []
@@ -0,0 +1,89 @@
+import base64
+from email.header import Header
+
+from app.ingest import IngestStats, detect_format, iter_emails
+
+
+def _gb2312_mbox() -> bytes:
+    subject = Header("季度报告", "gb2312").encode()
+    attachment = base64.encodebytes(b"\x00" * 4096)
+    first = (
+        b"From finance@example.com Mon Jan  1 00:00:00 2024\n"
+        b"Message-ID: <report-1@example.com>\n"
+        b"From: finance@example.com\n"
+        b"Subject: " + subject.encode() + b"\n"
+        b"Date: Mon, 01 Jan 2024 09:00:00 +0800\n"
+        b"MIME-Version: 1.0\n"
+        b"Content-Type: multipart/mixed; boundary=\"XX\"\n"
+        b"\n"
+        b"--XX\n"
+        b"Content-Type: text/plain; charset=gb2312\n"
+        b"Content-Transfer-Encoding: 8bit\n"
+        b"\n" + "请查收本季度报告。".encode("gb2312") + b"\n"
+        b">From the finance team\n"
+        b"\n"
+        b"--XX\n"
+        b"Content-Type: application/pdf; name=\"report.pdf\"\n"
+        b"Content-Disposition: attachment; filename=\"report.pdf\"\n"
+        b"Content-Transfer-Encoding: base64\n"
+        b"\n" + attachment + b"\n"
+        b"--XX--\n"
+    )
+    # 未编码的 8bit GBK 邮件头，且没有 Message-ID
+    second = (
+        b"From ops@example.com Tue Jan  2 00:00:00 2024\n"
+        b"From: ops@example.com\n"
+        b"Subject: " + "会议通知".encode("gbk") + b"\n"
+        b"Content-Type: text/plain; charset=gbk\n"
+        b"\n" + "明天上午开会。".encode("gbk") + b"\n"
+    )
+    # 以 BOM 和空行开头的 mbox 也应被识别
+    return b"\xef\xbb\xbf\n" + first + b"\n" + second
+
+
+def test_gb2312_mbox(tmp_path):
+    path = tmp_path / "archive.mbox"
+    path.write_bytes(_gb2312_mbox())
+    stats = IngestStats()
+
+    emails = list(iter_emails([str(path)], stats, max_attachment_bytes=1024))
+
+    assert [e["subject"] for e in emails] == ["季度报告", "会议通知"]
+    assert emails[0]["email_id"] == "report-1@example.com"
+    assert "请查收本季度报告。" in emails[0]["content"]
+    assert "\nFrom the finance team" in emails[0]["content"]
+    assert emails[0]["received_at"].startswith("2024-01-01T09:00:00")
+    assert "明天上午开会。" in emails[1]["content"]
+    assert stats.messages == 2
+    assert stats.attachments_skipped == 1
+    assert stats.parse_errors == 0
+
+
+def test_fallback_id_is_stable(tmp_path):
+    first, second = tmp_path / "a.mbox", tmp_path / "b.mbox"
+    first.write_bytes(_gb2312_mbox())
+    second.write_bytes(_gb2312_mbox())
+
+    ids = [[e["email_id"] for e in iter_emails([str(p)], IngestStats())] for p in (first, second)]
+
+    assert ids[0] == ids[1]
+    assert ids[0][1].startswith("raw-")
+
+
+def test_oversized_message_is_truncated(tmp_path):
+    path = tmp_path / "big.eml"
+    path.write_bytes(b"Subject: big\n\nhello\n" + b"x" * 10000)
+    stats = IngestStats()
+
+    emails = list(iter_emails([str(path)], stats, max_message_bytes=100))
+
+    assert emails[0]["subject"] == "big"
+    assert len(emails[0]["content"]) < 100
+    assert stats.messages_truncated == 1
+
+
+def test_detect_format():
+    assert detect_format(b"From a@b Mon Jan  1 00:00:00 2024\n") == "mbox"
+    assert detect_format(b"\xef\xbb\xbf\r\n\nFrom a@b Mon Jan  1 00:00:00 2024\n") == "mbox"
+    assert detect_format(b"From: a@b\nSubject: x\n\nbody\n") == "eml"
+    assert detect_format(b"\nSubject: x\n\nbody\n") == "eml"
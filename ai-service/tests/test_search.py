@@ -0,0 +1,266 @@
+import json
+import math
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import search
+from app.search import EmailSearchIndex, parse_query, parse_time_range
+
+NOW = datetime(2024, 3, 14, 15, 30)  # 星期四
+
+WORDS = ["会议", "项目", "报告", "合同", "客户", "发票", "预算", "审批", "服务器", "故障", "财务", "招聘"]
+
+QUERIES = [
+    "会议", "项目报告", "客户合同审批", "会议 合同 预算", "服务器故障 release",
+    "重要客户的合同", "紧急的会议", "不重要的通知",
+    "高优先级 服务器", "上周的发票", "最近3天紧急的财务邮件", "本月财务",
+]
+# 只有时间或优先级条件的查询
+FILTER_QUERIES = ["紧急", "低优先级的邮件", "最近3天紧急邮件", "上周", "本月高优先级"]
+
+
+def _random_doc(rng: random.Random, email_id: str) -> dict:
+    received_at = None if rng.random() < 0.15 else (NOW - timedelta(days=rng.random() * 40)).timestamp()
+    return {
+        "email_id": email_id,
+        "subject": "".join(rng.choices(WORDS, k=2)),
+        "summary": "".join(rng.choices(WORDS, k=4)) + " " + rng.choice(["release", "v2", "q1"]),
+        "tags": rng.sample(WORDS, 2),
+        "key_points": ["".join(rng.choices(WORDS, k=2))],
+        "priority": rng.choice(["high", "medium", "low"]),
+        "received_at": received_at,
+    }
+
+
+def _build(index: EmailSearchIndex, user_id: str, seed: int = 7, size: int = 400) -> dict:
+    """写入随机邮件，其中部分重新分析（旧版本被删除），返回每封邮件的最新版本"""
+    rng = random.Random(seed)
+    latest = {}
+    for i in range(size):
+        doc = _random_doc(rng, f"e{i}")
+        index.add(user_id, **doc)
+        latest[doc["email_id"]] = doc
+    for i in range(0, size, 3):
+        doc = _random_doc(rng, f"e{i}")
+        index.add(user_id, **doc)
+        latest[doc["email_id"]] = doc
+    return latest
+
+
+def _filters(query: str):
+    start, end, priority, boost, terms = parse_query(query, NOW)
+
+    def accept(doc: dict) -> bool:
+        if priority and doc["priority"] != priority:
+            return False
+        if start is not None:
+            received_at = doc["received_at"]
+            return received_at is not None and start <= received_at < end
+        return True
+
+    return accept, boost, terms
+
+
+def _brute_force_docs(docs: list, query: str, k: int) -> list:
+    """直接按 BM25 公式逐篇计算得分，不经过倒排表"""
+    accept, boost, terms = _filters(query)
+    k1, b = EmailSearchIndex.k1, EmailSearchIndex.b
+    weights = [EmailSearchIndex._term_weights(doc) for doc in docs]
+    lengths = [sum(w.values()) for w in weights]
+    avgdl = sum(lengths) / len(lengths)
+    n = len(docs)
+    scores = []
+    for doc, w, length in zip(docs, weights, lengths):
+        if not accept(doc) or not terms.intersection(w):
+            continue
+        score = 0.0
+        for term in terms.intersection(w):
+            df = sum(1 for other in weights if term in other)
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            tf = w[term]
+            score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / avgdl))
+        if boost and doc["priority"] == boost:
+            score += EmailSearchIndex.priority_boost
+        scores.append(score)
+    return sorted(scores, reverse=True)[:k]
+
+
+def _brute_force_postings(index: EmailSearchIndex, user_id: str, query: str, k: int) -> list:
+    """用写入时的 impact 逐条扫描倒排表，跳过已删除的旧版本"""
+    owner = index._owners[user_id]
+    accept, boost, terms = _filters(query)
+    n = len(owner.live)
+    scores = {}
+    for term in terms:
+        if term not in owner.postings:
+            continue
+        ids, impacts = owner.postings[term]
+        idf = math.log(1 + (n - len(ids) + 0.5) / (len(ids) + 0.5))
+        for doc_id, impact in zip(ids, impacts):
+            if owner.alive[doc_id] and accept(owner.docs[doc_id]):
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * impact
+    for doc_id in scores:
+        if boost and owner.docs[doc_id]["priority"] == boost:
+            scores[doc_id] += EmailSearchIndex.priority_boost
+    return sorted(scores.values(), reverse=True)[:k]
+
+
+def _assert_scores(results: list, expected: list):
+    assert len(results) == len(expected)
+    for result, score in zip(results, expected):
+        assert result["score"] == pytest.approx(score, abs=1e-3)
+
+
+@pytest.fixture(params=["exhaustive", "by_impact"])
+def search_path(request, monkeypatch):
+    """分别覆盖逐条扫描和按 impact 提前终止两条检索路径"""
+    if request.param == "by_impact":
+        monkeypatch.setattr(search, "_IMPACT_MIN_DF", 0)
+        monkeypatch.setattr(search, "_IMPACT_TAIL_LIMIT", 16)
+    else:
+        monkeypatch.setattr(search, "_IMPACT_MIN_DF", math.inf)
+    return request.param
+
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_search_matches_brute_force_after_reload(tmp_path, search_path, query):
+    path = str(tmp_path / "index.jsonl")
+    writer = EmailSearchIndex(path)
+    latest = _build(writer, "alice")
+    writer.close()
+
+    index = EmailSearchIndex(path)
+    index.load()
+    assert len(index) == len(latest)
+    expected = _brute_force_docs(list(latest.values()), query, 10)
+    _assert_scores(index.search(query, "alice", k=10, now=NOW), expected)
+
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_search_matches_brute_force_with_reanalysed_emails(search_path, query):
+    index = EmailSearchIndex()
+    _build(index, "alice")
+    # 检索后继续追加，按 impact 排序的缓存需要处理新增条目
+    index.search(query, "alice", k=5, now=NOW)
+    _build(index, "alice", seed=11, size=60)
+
+    for k in (1, 5, 20):
+        expected = _brute_force_postings(index, "alice", query, k)
+        _assert_scores(index.search(query, "alice", k=k, now=NOW), expected)
+
+
+@pytest.mark.parametrize("query", FILTER_QUERIES)
+def test_filter_only_queries_return_latest_matches(query):
+    index = EmailSearchIndex()
+    latest = _build(index, "alice")
+    accept, _, terms = _filters(query)
+    assert not terms
+
+    expected = sorted((doc["received_at"] or -math.inf for doc in latest.values() if accept(doc)), reverse=True)
+    for k in (3, 10, 50):
+        results = index.search(query, "alice", k=k, now=NOW)
+        assert all(accept(latest[r["email_id"]]) for r in results)
+        received = [latest[r["email_id"]]["received_at"] or -math.inf for r in results]
+        assert received == expected[:k]
+
+
+def test_search_never_returns_replaced_versions(search_path):
+    index = EmailSearchIndex()
+    index.add("alice", "e1", "服务器故障", "数据库宕机", ["故障"], [], "high")
+    index.add("alice", "e1", "周报", "本周进展", ["周报"], [], "low")
+
+    assert index.search("服务器故障", "alice", now=NOW) == []
+    assert [r["subject"] for r in index.search("周报", "alice", now=NOW)] == ["周报"]
+    assert index.stats("alice")["priority_distribution"] == {"high": 0, "medium": 0, "low": 1}
+
+
+def test_search_is_scoped_to_owner():
+    index = EmailSearchIndex()
+    index.add("alice", "e1", "合同审批", "供应商合同", ["合同"], [], "high")
+    index.add("bob", "e1", "合同续签", "客户合同", ["合同"], [], "low")
+
+    assert [r["subject"] for r in index.search("合同", "alice", now=NOW)] == ["合同审批"]
+    assert [r["subject"] for r in index.search("合同", "bob", now=NOW)] == ["合同续签"]
+    assert index.search("合同", None, now=NOW) == []
+    assert index.search("合同", "carol", now=NOW) == []
+    assert index.stats(None)["indexed_emails"] == 0
+    with pytest.raises(ValueError):
+        index.add("", "e2", "合同", "", [], [], "low")
+
+
+def test_priority_hint_boosts_instead_of_filtering():
+    index = EmailSearchIndex()
+    index.add("alice", "e1", "客户合同", "重要客户的合同", [], [], "medium")
+    index.add("alice", "e2", "客户合同", "合同草稿", [], [], "high")
+    index.add("alice", "e3", "周会", "例行会议", [], [], "high")
+
+    results = index.search("重要客户的合同", "alice", now=NOW)
+    assert {r["email_id"] for r in results} == {"e1", "e2"}
+
+    # 单独出现时按优先级过滤，按时间倒序返回
+    assert {r["email_id"] for r in index.search("紧急", "alice", now=NOW)} == {"e2", "e3"}
+    # 明确的优先级始终过滤
+    assert [r["email_id"] for r in index.search("高优先级 合同", "alice", now=NOW)] == ["e2"]
+
+
+def test_parse_query_priority():
+    assert parse_query("重要客户的合同", NOW)[2:4] == (None, "high")
+    assert parse_query("紧急", NOW)[2:] == ("high", None, set())
+    assert parse_query("不重要的通知", NOW)[2:4] == (None, "low")
+    assert parse_query("高优先级 服务器", NOW)[2:] == ("high", None, {"服务", "务器"})
+
+
+def test_undated_emails_excluded_from_time_filters(search_path):
+    index = EmailSearchIndex()
+    index.add("alice", "e1", "发票", "三月发票", [], [], "low", (NOW - timedelta(days=1)).isoformat())
+    index.add("alice", "e2", "发票", "没有日期的发票", [], [], "low")
+    index.add("alice", "e3", "发票", "很久以前的发票", [], [], "low", datetime(2023, 1, 5))
+
+    assert [r["email_id"] for r in index.search("最近3天的发票", "alice", now=NOW)] == ["e1"]
+    assert [r["email_id"] for r in index.search("最近3天", "alice", now=NOW)] == ["e1"]
+    assert {r["email_id"] for r in index.search("发票", "alice", now=NOW)} == {"e1", "e2", "e3"}
+    undated = next(r for r in index.search("发票", "alice", now=NOW) if r["email_id"] == "e2")
+    assert undated["received_at"] is None
+
+
+def test_load_skips_placeholders_mock_results_and_ownerless_entries(tmp_path):
+    path = tmp_path / "index.jsonl"
+    base = {"subject": "预算", "summary": "预算审批", "key_points": [], "priority": "high", "received_at": None}
+    entries = [
+        dict(base, user_id="alice", email_id="ok", tags=["财务"]),
+        dict(base, user_id="alice", email_id="failed", tags=["分析失败"]),
+        dict(base, user_id="alice", email_id="mock", tags=["工作", "待回复"], key_points=["需要回复", "查看详情"]),
+        dict(base, email_id="legacy", tags=["财务"]),
+    ]
+    path.write_text("\n".join(json.dumps(e, ensure_ascii=False) for e in entries) + "\n{\"truncated", "utf-8")
+
+    index = EmailSearchIndex(str(path))
+    index.load()
+    assert len(index) == 1
+    assert [r["email_id"] for r in index.search("预算", "alice", now=NOW)] == ["ok"]
+
+
+@pytest.mark.parametrize("query, start, end, rest", [
+    ("今天的会议", datetime(2024, 3, 14), NOW, " 的会议"),
+    ("昨天的会议", datetime(2024, 3, 13), datetime(2024, 3, 14), " 的会议"),
+    ("上周财务相关的紧急邮件", datetime(2024, 3, 4), datetime(2024, 3, 11), " 财务相关的紧急邮件"),
+    ("本周的会议", datetime(2024, 3, 11), NOW, " 的会议"),
+    ("上个月的发票", datetime(2024, 2, 1), datetime(2024, 3, 1), " 的发票"),
+    ("本月报销", datetime(2024, 3, 1), NOW, " 报销"),
+    ("最近3天的邮件", datetime(2024, 3, 12), NOW, " 的邮件"),
+    ("近七天的故障", datetime(2024, 3, 8), NOW, " 的故障"),
+])
+def test_parse_time_range(query, start, end, rest):
+    assert parse_time_range(query, NOW) == (start.timestamp(), end.timestamp(), rest)
+
+
+def test_parse_time_range_without_time():
+    assert parse_time_range("项目报告", NOW) == (None, None, "项目报告")
+
+
+def test_parse_time_range_last_month_in_january():
+    now = datetime(2024, 1, 10, 9, 0)
+    start, end, _ = parse_time_range("上月的账单", now)
+    assert (start, end) == (datetime(2023, 12, 1).timestamp(), datetime(2024, 1, 1).timestamp())
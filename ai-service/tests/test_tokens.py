@@ -0,0 +1,89 @@
+import pytest
+
+from app import tokens
+from app.config import config
+from app.tokens import (
+    InputTooLargeError,
+    TokenUsageTracker,
+    count_message_tokens,
+    count_tokens,
+    plan_request,
+    truncate_to_tokens,
+)
+
+
+@pytest.fixture(autouse=True)
+def estimate_only(monkeypatch):
+    """不依赖 tiktoken 编码文件，统一使用估算计数"""
+    monkeypatch.setattr(tokens, "_encodings", {})
+    monkeypatch.setattr(config, "OPENAI_MODEL", "gpt-3.5-turbo")
+    monkeypatch.setattr(config, "OPENAI_FAST_MODEL", "")
+    monkeypatch.setattr(config, "MAX_INPUT_TOKENS", 3000)
+    monkeypatch.setattr(config, "OVERSIZE_POLICY", "trim")
+
+
+def build_messages(body):
+    return [{"role": "system", "content": "分析邮件"}, {"role": "user", "content": body}]
+
+
+def test_count_tokens_cjk():
+    assert count_tokens("") == 0
+    assert count_tokens("abcd" * 10) == 10
+    assert count_tokens("中文" * 10) == 30
+
+
+def test_truncate_to_tokens():
+    text = "中文邮件正文" * 100
+    truncated = truncate_to_tokens(text, 50)
+    assert count_tokens(truncated) <= 50
+    assert text.startswith(truncated)
+    # 再多一个字就会超限，说明取到了最长前缀
+    assert count_tokens(text[:len(truncated) + 1]) > 50
+    assert truncate_to_tokens("short", 50) == "short"
+    assert truncate_to_tokens("short", 0) == ""
+
+
+def test_plan_request_fits():
+    messages, plan = plan_request("analysis", build_messages, "短邮件", 300)
+    assert messages == build_messages("短邮件")
+    assert not plan.truncated
+    assert plan.prompt_tokens == count_message_tokens(messages)
+    assert plan.max_tokens == 300
+
+
+def test_plan_request_trims_oversize(monkeypatch):
+    monkeypatch.setattr(config, "MAX_INPUT_TOKENS", 100)
+    body = "很长的邮件正文" * 200
+    messages, plan = plan_request("analysis", build_messages, body, 300)
+    assert plan.truncated
+    assert plan.input_tokens == count_tokens(body)
+    assert count_tokens(messages[1]["content"]) <= 100
+    assert plan.prompt_tokens + plan.max_tokens <= tokens.get_context_window("gpt-3.5-turbo")
+
+
+def test_plan_request_reject(monkeypatch):
+    monkeypatch.setattr(config, "MAX_INPUT_TOKENS", 100)
+    monkeypatch.setattr(config, "OVERSIZE_POLICY", "reject")
+    with pytest.raises(InputTooLargeError) as excinfo:
+        plan_request("analysis", build_messages, "很长的邮件正文" * 200, 300)
+    assert excinfo.value.limit == 100
+
+
+def test_plan_request_routes_small_input(monkeypatch):
+    monkeypatch.setattr(config, "OPENAI_FAST_MODEL", "gpt-4o-mini")
+    monkeypatch.setattr(config, "FAST_MODEL_TOKEN_THRESHOLD", 50)
+    assert plan_request("analysis", build_messages, "短邮件", 300)[1].model == "gpt-4o-mini"
+    assert plan_request("analysis", build_messages, "长" * 100, 300)[1].model == "gpt-3.5-turbo"
+
+
+def test_usage_keeps_local_estimate():
+    _, plan = plan_request("analysis", build_messages, "短邮件", 300)
+    estimated = plan.prompt_tokens
+    tracker = TokenUsageTracker()
+    tracker.record(plan, {"prompt_tokens": estimated + 7, "completion_tokens": 20})
+
+    assert plan.to_dict()["estimated_prompt_tokens"] == estimated
+    assert plan.to_dict()["prompt_tokens"] == estimated + 7
+    entry = tracker.to_dict()["by_task"]["analysis"]
+    assert entry["estimated_prompt_tokens"] == estimated
+    assert entry["prompt_tokens"] == estimated + 7